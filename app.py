@@ -1,19 +1,74 @@
 import os
+import atexit
+import hashlib
+import heapq
+import hmac
 import json
 import logging
+import logging.handlers
+import queue
+import random
+import re
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+import zlib
+from email.utils import parsedate_to_datetime
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+import functools
+import click
 from flask import Flask, request, jsonify
-import stripe
 import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
-# Configure logging - use DEBUG level for verbose output
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
+# Logging - LOG_LEVEL=DEBUG adds per-field extraction detail and full event dumps;
+# LOG_FORMAT=json emits one JSON object per line instead of plain text
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text').lower()
+
+
+class StructuredFormatter(logging.Formatter):
+    """Format records as single-line JSON, including the fields of log_stage() records."""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        if hasattr(record, 'stage'):
+            entry['stage'] = record.stage
+            entry['event_id'] = record.event_id
+            entry.update(record.fields)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging():
+    """Send all log records through a queue so stdout writes happen on a background thread."""
+    stream_handler = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == 'json':
+        stream_handler.setFormatter(StructuredFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(LOG_LEVEL)
+
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+
+configure_logging()
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
@@ -23,8 +78,171 @@ STRIPE_WEBHOOK_SECRET = os.getenv('STRIPE_WEBHOOK_SECRET')
 GHL_API_KEY = os.getenv('GHL_API_KEY')
 GHL_LOCATION_ID = os.getenv('GHL_LOCATION_ID')
 
+# Stripe signing secrets - comma-separate several to accept both while rotating secrets.
+# Signatures older than the tolerance (seconds) are rejected to prevent replays.
+STRIPE_WEBHOOK_SECRETS = [s.strip() for s in (STRIPE_WEBHOOK_SECRET or '').split(',') if s.strip()]
+STRIPE_SIGNATURE_TOLERANCE = int(os.getenv('STRIPE_SIGNATURE_TOLERANCE', 300))
+
 # GHL API v2 base URL
 GHL_BASE_URL = 'https://services.leadconnectorhq.com'
+GHL_API_VERSION = '2021-07-28'
+
+# GHL HTTP client - (connect, read) timeouts in seconds, and the number of pooled
+# keep-alive connections (defaults to one per queue worker plus headroom)
+GHL_CONNECT_TIMEOUT = float(os.getenv('GHL_CONNECT_TIMEOUT', 5))
+GHL_READ_TIMEOUT = float(os.getenv('GHL_READ_TIMEOUT', 20))
+GHL_POOL_SIZE = int(os.getenv('GHL_POOL_SIZE', 0))
+GHL_WARM_CONNECTIONS = int(os.getenv('GHL_WARM_CONNECTIONS', 2))
+
+# GHL rate limiting - burst allowance per interval for this process (GHL allows 100 per 10s
+# per location; divide it between web workers), the share of it kept back for live syncs
+# while background jobs run, and how many times a 429 is retried before giving up
+GHL_RATE_LIMIT_BURST = int(os.getenv('GHL_RATE_LIMIT_BURST', 100))
+GHL_RATE_LIMIT_INTERVAL = float(os.getenv('GHL_RATE_LIMIT_INTERVAL', 10))
+GHL_RATE_LIMIT_RESERVE = float(os.getenv('GHL_RATE_LIMIT_RESERVE', 0.2))
+GHL_MAX_429_RETRIES = int(os.getenv('GHL_MAX_429_RETRIES', 3))
+
+# GHL circuit breaker - opens when at least GHL_BREAKER_ERROR_RATE of the calls in the last
+# GHL_BREAKER_WINDOW seconds failed (5xx / network errors, minimum GHL_BREAKER_MIN_CALLS
+# calls), then lets one probe call through after GHL_BREAKER_COOLDOWN seconds
+GHL_BREAKER_WINDOW = float(os.getenv('GHL_BREAKER_WINDOW', 60))
+GHL_BREAKER_MIN_CALLS = int(os.getenv('GHL_BREAKER_MIN_CALLS', 10))
+GHL_BREAKER_ERROR_RATE = float(os.getenv('GHL_BREAKER_ERROR_RATE', 0.5))
+GHL_BREAKER_COOLDOWN = float(os.getenv('GHL_BREAKER_COOLDOWN', 30))
+
+# Background sync queue - webhooks are stored here and synced to GHL by worker threads.
+# The database also holds retries, the spend ledger and the contact index, so on Railway it
+# must live on a volume (used automatically when one is attached) to survive redeploys
+SYNC_DB_PATH = os.getenv('SYNC_DB_PATH', os.path.join(os.getenv('RAILWAY_VOLUME_MOUNT_PATH', '.'), 'sync.db'))
+QUEUE_WORKERS = int(os.getenv('QUEUE_WORKERS', 4))
+QUEUE_VISIBILITY_TIMEOUT = float(os.getenv('QUEUE_VISIBILITY_TIMEOUT', 300))
+# Events are sharded by a hash of their contact key (contactId, or the email for events
+# without one); a shard is only synced by one worker at a time (across all processes), so
+# each key's updates are applied in order
+QUEUE_SHARDS = int(os.getenv('QUEUE_SHARDS', 256))
+# Idle workers are woken by new events and by the retry timer; this poll only picks up
+# events queued by other processes (e.g. `flask redrive`)
+QUEUE_POLL_INTERVAL = float(os.getenv('QUEUE_POLL_INTERVAL', 5.0))
+
+# Retries - failed syncs back off exponentially with full jitter (base * 2^attempt, capped),
+# and move to the dead-letter table after QUEUE_MAX_ATTEMPTS or on a permanent error
+QUEUE_MAX_ATTEMPTS = int(os.getenv('QUEUE_MAX_ATTEMPTS', 8))
+RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', 5))
+RETRY_MAX_DELAY = float(os.getenv('RETRY_MAX_DELAY', 1800))
+
+# Idempotency - Stripe retries for up to 3 days, so remember event IDs for longer than that
+IDEMPOTENCY_TTL = float(os.getenv('IDEMPOTENCY_TTL', 7 * 24 * 3600))
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv('IDEMPOTENCY_CACHE_SIZE', 10000))
+
+# Email -> GHL contactId cache. Negative entries (email unknown to GHL) expire much sooner
+CONTACT_CACHE_SIZE = int(os.getenv('CONTACT_CACHE_SIZE', 10000))
+CONTACT_CACHE_TTL = float(os.getenv('CONTACT_CACHE_TTL', 6 * 3600))
+CONTACT_CACHE_NEGATIVE_TTL = float(os.getenv('CONTACT_CACHE_NEGATIVE_TTL', 300))
+
+# Upsert mode - contacts found only by email are created/updated with one call to GHL's
+# upsert endpoint instead of a lookup followed by an update (and missing ones are created)
+GHL_UPSERT_CONTACTS = os.getenv('GHL_UPSERT_CONTACTS', 'false').lower() in ('1', 'true', 'yes')
+
+# Emails of queued events that aren't known locally are resolved up to this many at a time
+# with one contact search (1 disables batching)
+CONTACT_BATCH_SIZE = int(os.getenv('CONTACT_BATCH_SIZE', 100))
+
+# Contact index - every contact in the location (email -> contactId) mirrored into the sync
+# database, refreshed incrementally this often (seconds, 0 disables the background refresh)
+CONTACT_INDEX_REFRESH = float(os.getenv('CONTACT_INDEX_REFRESH', 900))
+CONTACT_INDEX_PAGE_SIZE = int(os.getenv('CONTACT_INDEX_PAGE_SIZE', 500))
+# Bytes of the sync database read through a memory map instead of read() calls
+SYNC_DB_MMAP_SIZE = int(os.getenv('SYNC_DB_MMAP_SIZE', 256 * 1024 * 1024))
+
+# GHL contact webhooks (/ghl/webhook) keep the contact index and cache up to date between
+# refreshes. The route is disabled until a token is set; add it to the webhook URL as ?token=...
+GHL_WEBHOOK_TOKEN = os.getenv('GHL_WEBHOOK_TOKEN')
+GHL_CONTACT_EVENTS = ('ContactCreate', 'ContactUpdate', 'ContactDelete', 'ContactMerge')
+
+# Custom field definitions (key -> field ID) are reloaded from GHL this often (seconds)
+CUSTOM_FIELD_REFRESH = float(os.getenv('CUSTOM_FIELD_REFRESH', 3600))
+# After a failed load, writes go out by key and the load isn't retried for this long
+CUSTOM_FIELD_RETRY = float(os.getenv('CUSTOM_FIELD_RETRY', 60))
+
+# Last-written custom field values are trusted for this long before being re-sent to GHL
+FIELD_STATE_TTL = float(os.getenv('FIELD_STATE_TTL', 30 * 24 * 3600))
+
+# Events for the same payment (checkout session / payment intent / charge) are held this
+# many seconds so they can be merged into a single GHL update
+COALESCE_WINDOW = float(os.getenv('COALESCE_WINDOW', 10))
+
+# Events for the same contact are held until the contact has had no new events for
+# CONTACT_DEBOUNCE seconds (but at most CONTACT_MAX_WAIT after the first), then all of
+# them are sent as one GHL update. 0 disables the debounce
+CONTACT_DEBOUNCE = float(os.getenv('CONTACT_DEBOUNCE', 10))
+CONTACT_MAX_WAIT = float(os.getenv('CONTACT_MAX_WAIT', 60))
+
+# Where each value is found in a Stripe event's data.object, in priority order. Paths are
+# dotted and integer segments index into lists. EXTRACTION_RULES lists the event types we
+# handle, each overriding the default paths for the fields where that type differs.
+EXTRACTION_DEFAULTS = {
+    'contact_id': ['metadata.contactId'],
+    'payment_id': ['payment_intent.id', 'payment_intent'],
+    'email': [
+        'customer_details.email',
+        'receipt_email',
+        'billing_details.email',
+        'charges.data.0.billing_details.email',
+        'latest_charge.billing_details.email',
+        'customer_email',
+    ],
+    'name': ['billing_details.name', 'charges.data.0.billing_details.name', 'customer_details.name'],
+    'address': ['billing_details.address', 'charges.data.0.billing_details.address', 'customer_details.address'],
+    'amount': ['amount_total', 'amount'],
+}
+EXTRACTION_RULES = {
+    'checkout.session.completed': {
+        'email': ['customer_details.email', 'customer_email'],
+        'name': ['customer_details.name'],
+        'address': ['customer_details.address'],
+        'amount': ['amount_total'],
+    },
+    'payment_intent.succeeded': {
+        'payment_id': ['id'],
+        'email': ['receipt_email', 'charges.data.0.billing_details.email', 'latest_charge.billing_details.email'],
+        'name': ['charges.data.0.billing_details.name', 'latest_charge.billing_details.name'],
+        'address': ['charges.data.0.billing_details.address', 'latest_charge.billing_details.address'],
+        'amount': ['amount'],
+    },
+    'charge.succeeded': {
+        'email': ['receipt_email', 'billing_details.email'],
+        'name': ['billing_details.name'],
+        'address': ['billing_details.address'],
+        'amount': ['amount'],
+    },
+}
+
+# Path prefixes Stripe no longer sends from the given API version on
+# (PaymentIntent.charges was removed in 2022-11-15)
+EXTRACTION_PATHS_REMOVED = {
+    'charges.': '2022-11-15',
+}
+
+# Stripe event types that carry payment/billing data
+HANDLED_EVENT_TYPES = tuple(EXTRACTION_RULES)
+
+# Pre-filter on the raw webhook body: matches `"type": "<handled type>"` anywhere in it.
+# Handled type names never occur as values of nested "type" keys, so when this doesn't
+# match, the event's top-level type isn't one we handle and it needn't be decoded at all.
+HANDLED_TYPE_PATTERN = re.compile(
+    rb'"type"\s*:\s*"(?:' + b'|'.join(re.escape(t.encode()) for t in HANDLED_EVENT_TYPES) + rb')"'
+)
+
+# GHL contact custom field keys, keyed by the name used in the extracted billing data
+CUSTOM_FIELD_KEYS = {
+    'name': 'card_name',
+    'address_line_1': 'card_address_line_1',
+    'address_line_2': 'card_address_line_2',
+    'city': 'card_address_city',
+    'state': 'card_address_state',
+    'country': 'card_address_country',
+    'amount': 'total_spend',
+}
 
 
 def safe_json(obj, max_length=2000):
@@ -38,10 +256,1425 @@ def safe_json(obj, max_length=2000):
         return f'[Could not serialize: {e}]'
 
 
+class Lazy:
+    """Log argument that calls `func(*args)` only if the record is actually emitted."""
+
+    __slots__ = ('func', 'args')
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        return str(self.func(*self.args))
+
+
+class StageFields(dict):
+    """Fields of a log_stage() record, rendered as key=value pairs in text logs."""
+
+    def __str__(self):
+        return ' '.join(f'{key}={value}' for key, value in self.items() if value is not None)
+
+
+def log_stage(level, stage, event_id, **fields):
+    """Emit one structured record for a processing stage of an event."""
+    if logger.isEnabledFor(level):
+        fields = StageFields(fields)
+        logger.log(level, '[%s] %s %s', stage, event_id, fields,
+                   extra={'stage': stage, 'event_id': event_id, 'fields': fields})
+
+
+class LRUCache:
+    """Thread-safe bounded LRU mapping with an optional per-entry TTL and hit/miss counters."""
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None, count=True):
+        """Return the value for `key`. With count=False the lookup doesn't touch the hit/miss stats."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += count
+                return default
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += count
+                return default
+            self._data.move_to_end(key)
+            self.hits += count
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        """Return size and hit/miss/eviction counters for monitoring."""
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+        }
+
+
+class SingleFlight:
+    """Collapses concurrent calls for the same key into one: the first caller runs the
+    function and everyone who asks for the key while it runs gets its result (or error)."""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.shared = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'done': threading.Event()}
+            else:
+                self.shared += 1
+
+        if not leader:
+            call['done'].wait()
+            if 'error' in call:
+                raise call['error']
+            return call['result']
+
+        try:
+            call['result'] = fn()
+            return call['result']
+        except BaseException as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['done'].set()
+
+
+# ---------------------------------------------------------------------------
+# Sync database (SQLite, WAL mode) - one connection per thread
+# ---------------------------------------------------------------------------
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS event_queue (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    event_id TEXT NOT NULL UNIQUE,
+    event_type TEXT NOT NULL,
+    correlation_key TEXT,
+    contact_key TEXT,
+    shard INTEGER,
+    email TEXT,
+    payload BLOB NOT NULL,
+    received_at REAL NOT NULL,
+    available_at REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_expires REAL
+);
+CREATE INDEX IF NOT EXISTS idx_event_queue_available ON event_queue (available_at);
+CREATE INDEX IF NOT EXISTS idx_event_queue_correlation ON event_queue (correlation_key);
+CREATE INDEX IF NOT EXISTS idx_event_queue_email ON event_queue (email);
+CREATE INDEX IF NOT EXISTS idx_event_queue_contact ON event_queue (contact_key);
+CREATE INDEX IF NOT EXISTS idx_event_queue_lease ON event_queue (lease_expires);
+
+CREATE TABLE IF NOT EXISTS processed_events (
+    event_id TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_processed_events_expires ON processed_events (expires_at);
+
+CREATE TABLE IF NOT EXISTS dead_letters (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    event_id TEXT NOT NULL UNIQUE,
+    event_type TEXT NOT NULL,
+    correlation_key TEXT,
+    payload BLOB NOT NULL,
+    attempts INTEGER NOT NULL,
+    error TEXT,
+    failed_at REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS payments (
+    payment_id TEXT PRIMARY KEY,
+    contact_id TEXT NOT NULL,
+    amount_cents INTEGER NOT NULL,
+    recorded_at REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS contact_totals (
+    contact_id TEXT PRIMARY KEY,
+    total_cents INTEGER NOT NULL,
+    payment_count INTEGER NOT NULL,
+    updated_at REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS contact_index (
+    email TEXT PRIMARY KEY,
+    contact_id TEXT NOT NULL,
+    date_updated TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_contact_index_contact ON contact_index (contact_id);
+
+CREATE TABLE IF NOT EXISTS sync_state (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS contact_fields (
+    contact_id TEXT NOT NULL,
+    field_key TEXT NOT NULL,
+    value_hash TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (contact_id, field_key)
+);
+
+CREATE TABLE IF NOT EXISTS contact_high_water (
+    contact_id TEXT PRIMARY KEY,
+    event_created INTEGER NOT NULL,
+    updated_at REAL NOT NULL
+);
+'''
+
+# Columns added to existing tables after their first release: (table, column, type)
+MIGRATIONS = [
+    ('event_queue', 'email', 'TEXT'),
+    ('event_queue', 'contact_key', 'TEXT'),
+    ('event_queue', 'shard', 'INTEGER'),
+]
+
+_db_local = threading.local()
+_db_init_lock = threading.Lock()
+_db_initialized = False
+
+
+def get_db():
+    """Return this thread's connection to the sync database, creating the schema on first use."""
+    global _db_initialized
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(SYNC_DB_PATH, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA mmap_size={SYNC_DB_MMAP_SIZE}')
+        with _db_init_lock:
+            if not _db_initialized:
+                migrate_db(conn)
+                conn.executescript(SCHEMA)
+                _db_initialized = True
+        _db_local.conn = conn
+    return conn
+
+
+def migrate_db(conn):
+    """Add columns from MIGRATIONS that a database created by an older release lacks."""
+    for table, column, column_type in MIGRATIONS:
+        columns = {r['name'] for r in conn.execute(f'PRAGMA table_info({table})')}
+        if columns and column not in columns:
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+
+
+@contextmanager
+def db_transaction():
+    """Run a block inside a write transaction on this thread's connection."""
+    conn = get_db()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+
+# ---------------------------------------------------------------------------
+# Event queue - /webhook stores events, worker threads lease and sync them
+# ---------------------------------------------------------------------------
+
+_queue_wakeup = threading.Event()
+
+
+class TimerQueue:
+    """Min-heap of deadlines at which delayed queue events (coalescing windows, retries) become due.
+
+    A single thread sleeps until the earliest deadline and then wakes the queue workers, so
+    pending retries never hold a worker thread. The deadlines themselves are persisted as
+    `event_queue.available_at` and reloaded with load_pending() after a restart.
+    """
+
+    def __init__(self, on_due):
+        self.on_due = on_due
+        self._heap = []
+        self._cond = threading.Condition()
+
+    def schedule(self, due):
+        """Wake the workers at `due` (epoch seconds)."""
+        with self._cond:
+            heapq.heappush(self._heap, due)
+            if self._heap[0] == due:
+                self._cond.notify()
+
+    def load_pending(self):
+        """Schedule every delayed event already in the queue. Returns the number loaded."""
+        now = time.time()
+        rows = get_db().execute(
+            'SELECT DISTINCT available_at FROM event_queue WHERE available_at > ?', (now,)
+        ).fetchall()
+        with self._cond:
+            for row in rows:
+                self._heap.append(row['available_at'])
+            heapq.heapify(self._heap)
+            self._cond.notify()
+        return len(rows)
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._heap:
+                    self._cond.wait()
+                delay = self._heap[0] - time.time()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                # Everything due by now is handled by a single wake-up
+                now = time.time()
+                while self._heap and self._heap[0] <= now:
+                    heapq.heappop(self._heap)
+            self.on_due()
+
+    def __len__(self):
+        return len(self._heap)
+
+
+retry_timer = TimerQueue(on_due=_queue_wakeup.set)
+
+
+def contact_shard(contact_key):
+    """Map a contact key to its queue shard, using a hash that's the same in every process."""
+    return zlib.crc32(contact_key.encode('utf-8')) % QUEUE_SHARDS if contact_key else None
+
+
+def enqueue_event(event_id, event_type, payload, correlation_key=None, email=None, contact_key=None):
+    """Store a verified Stripe event for background sync. Duplicate event IDs are ignored.
+
+    Events with a correlation key (payment intent ID) are held for COALESCE_WINDOW seconds
+    so the other events for the same payment can be processed with them. Events with a
+    contact key are debounced per contact (CONTACT_DEBOUNCE / CONTACT_MAX_WAIT). `email`
+    is the normalized email to resolve for events without a contactId, for batched lookups.
+    """
+    now = time.time()
+    available_at = now + COALESCE_WINDOW if correlation_key else now
+    with db_transaction() as conn:
+        if contact_key and CONTACT_DEBOUNCE > 0:
+            # Push the contact's waiting events back to the new debounce deadline
+            first = conn.execute(
+                'SELECT MIN(received_at) AS first FROM event_queue WHERE contact_key = ? '
+                'AND (lease_expires IS NULL OR lease_expires <= ?)',
+                (contact_key, now)
+            ).fetchone()['first']
+            available_at = max(available_at, min(now + CONTACT_DEBOUNCE, (first or now) + CONTACT_MAX_WAIT))
+            conn.execute(
+                'UPDATE event_queue SET available_at = ? WHERE contact_key = ? AND available_at < ? '
+                'AND (lease_expires IS NULL OR lease_expires <= ?)',
+                (available_at, contact_key, available_at, now)
+            )
+        cursor = conn.execute(
+            'INSERT OR IGNORE INTO event_queue '
+            '(event_id, event_type, correlation_key, contact_key, shard, email, payload, received_at, available_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (event_id, event_type, correlation_key, contact_key, contact_shard(contact_key), email, payload,
+             now, available_at)
+        )
+    if available_at > now:
+        retry_timer.schedule(available_at)
+    else:
+        _queue_wakeup.set()
+    return cursor.rowcount == 1
+
+
+def lease_events(worker_id):
+    """Lease the oldest available event, plus any queued events for the same payment or contact.
+
+    Events in a shard that another worker holds a lease in are skipped, so a slow or stuck
+    contact only holds up its own shard. The leased rows are hidden from other workers for
+    QUEUE_VISIBILITY_TIMEOUT seconds. Returns an empty list if nothing is available.
+    """
+    now = time.time()
+    lease_expires = now + QUEUE_VISIBILITY_TIMEOUT
+    with db_transaction() as conn:
+        row = conn.execute(
+            'SELECT * FROM event_queue WHERE available_at <= ? '
+            'AND (lease_expires IS NULL OR lease_expires <= ?) '
+            'AND (shard IS NULL OR shard NOT IN ('
+            'SELECT shard FROM event_queue WHERE lease_expires > ? AND shard IS NOT NULL)) '
+            'ORDER BY id LIMIT 1',
+            (now, now, now)
+        ).fetchone()
+        if row is None:
+            return []
+        rows = [row]
+        if row['correlation_key'] or row['contact_key']:
+            # Events for the same payment can sit in another shard (see contact_reference);
+            # only take them if nobody else is working on that shard
+            rows += conn.execute(
+                'SELECT * FROM event_queue WHERE (correlation_key = ? OR contact_key = ?) AND id != ? '
+                'AND (lease_expires IS NULL OR lease_expires <= ?) '
+                'AND (shard IS NULL OR shard = ? OR shard NOT IN ('
+                'SELECT shard FROM event_queue WHERE lease_expires > ? AND shard IS NOT NULL)) '
+                'ORDER BY id',
+                (row['correlation_key'], row['contact_key'], row['id'], now, row['shard'], now)
+            ).fetchall()
+        conn.executemany(
+            'UPDATE event_queue SET lease_owner = ?, lease_expires = ?, attempts = attempts + 1 WHERE id = ?',
+            [(worker_id, lease_expires, r['id']) for r in rows]
+        )
+    return rows
+
+
+def retry_events(rows, worker_id, delay, count_attempt=True):
+    """Release leased events so they become available again after `delay` seconds.
+
+    With count_attempt=False the lease isn't counted towards QUEUE_MAX_ATTEMPTS.
+    """
+    available_at = time.time() + delay
+    get_db().executemany(
+        'UPDATE event_queue SET lease_owner = NULL, lease_expires = NULL, available_at = ?, '
+        'attempts = attempts - ? WHERE id = ? AND lease_owner = ?',
+        [(available_at, 0 if count_attempt else 1, r['id'], worker_id) for r in rows]
+    )
+    retry_timer.schedule(available_at)
+
+
+def dead_letter_events(rows, worker_id, error):
+    """Move leased events from the queue to the dead-letter table."""
+    now = time.time()
+    with db_transaction() as conn:
+        for r in rows:
+            deleted = conn.execute(
+                'DELETE FROM event_queue WHERE id = ? AND lease_owner = ?', (r['id'], worker_id)
+            ).rowcount
+            if not deleted:
+                continue
+            conn.execute(
+                'INSERT OR REPLACE INTO dead_letters '
+                '(event_id, event_type, correlation_key, payload, attempts, error, failed_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (r['event_id'], r['event_type'], r['correlation_key'], r['payload'],
+                 r['attempts'] + 1, str(error)[:1000], now)
+            )
+
+
+def redrive_dead_letters(limit=None, rate=2.0, event_ids=None):
+    """Move dead-lettered events back onto the queue, at most `rate` events per second.
+
+    Returns the number of events re-queued.
+    """
+    conn = get_db()
+    query = 'SELECT * FROM dead_letters'
+    params = []
+    if event_ids:
+        query += f' WHERE event_id IN ({",".join("?" * len(event_ids))})'
+        params += list(event_ids)
+    query += ' ORDER BY id'
+    if limit:
+        query += ' LIMIT ?'
+        params.append(limit)
+
+    requeued = 0
+    for r in conn.execute(query, params).fetchall():
+        now = time.time()
+        try:
+            contact_key, email = contact_reference(json.loads(r['payload']))
+        except (ValueError, KeyError, TypeError):
+            contact_key, email = None, None
+        with db_transaction() as tx:
+            tx.execute(
+                'INSERT OR IGNORE INTO event_queue '
+                '(event_id, event_type, correlation_key, contact_key, shard, email, payload, received_at, available_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (r['event_id'], r['event_type'], r['correlation_key'], contact_key, contact_shard(contact_key),
+                 email, r['payload'], now, now)
+            )
+            tx.execute('DELETE FROM dead_letters WHERE id = ?', (r['id'],))
+        requeued += 1
+        _queue_wakeup.set()
+        logger.info(f'[Redrive] Re-queued {r["event_id"]} ({r["event_type"]}), last error: {r["error"]}')
+        if rate:
+            time.sleep(1 / rate)
+    return requeued
+
+
+def ack_events(rows, worker_id):
+    """Remove processed events from the queue if this worker still holds their lease."""
+    get_db().executemany(
+        'DELETE FROM event_queue WHERE id = ? AND lease_owner = ?',
+        [(r['id'], worker_id) for r in rows]
+    )
+
+
+# ---------------------------------------------------------------------------
+# Idempotency store - event ID -> in_flight / processed / failed
+# ---------------------------------------------------------------------------
+
+EVENT_IN_FLIGHT = 'in_flight'
+EVENT_PROCESSED = 'processed'
+EVENT_FAILED = 'failed'
+
+# Only the terminal "processed" state is cached in memory; other states can still change
+_processed_cache = LRUCache(IDEMPOTENCY_CACHE_SIZE)
+_last_idempotency_purge = 0.0
+
+
+def get_event_state(event_id):
+    """Return the recorded state for an event ID, or None if it has not been seen (or expired)."""
+    if _processed_cache.get(event_id):
+        return EVENT_PROCESSED
+    row = get_db().execute(
+        'SELECT state FROM processed_events WHERE event_id = ? AND expires_at > ?',
+        (event_id, time.time())
+    ).fetchone()
+    if row is None:
+        return None
+    if row['state'] == EVENT_PROCESSED:
+        _processed_cache.set(event_id, True)
+    return row['state']
+
+
+def set_event_state(event_id, state):
+    """Record the state of an event ID for IDEMPOTENCY_TTL seconds."""
+    global _last_idempotency_purge
+    now = time.time()
+    conn = get_db()
+    conn.execute(
+        'INSERT INTO processed_events (event_id, state, updated_at, expires_at) VALUES (?, ?, ?, ?) '
+        'ON CONFLICT(event_id) DO UPDATE SET state = excluded.state, '
+        'updated_at = excluded.updated_at, expires_at = excluded.expires_at',
+        (event_id, state, now, now + IDEMPOTENCY_TTL)
+    )
+    if state == EVENT_PROCESSED:
+        _processed_cache.set(event_id, True)
+    else:
+        _processed_cache.pop(event_id)
+
+    # Drop expired records at most once an hour
+    if now - _last_idempotency_purge > 3600:
+        _last_idempotency_purge = now
+        deleted = conn.execute('DELETE FROM processed_events WHERE expires_at <= ?', (now,)).rowcount
+        if deleted:
+            logger.info(f'[Idempotency] Purged {deleted} expired event records')
+
+
+# ---------------------------------------------------------------------------
+# Stripe webhook signatures - verified directly on the raw request body
+# ---------------------------------------------------------------------------
+
+class SignatureError(Exception):
+    """The Stripe-Signature header doesn't match the payload."""
+
+
+def verify_stripe_signature(payload, sig_header, secrets, tolerance=STRIPE_SIGNATURE_TOLERANCE):
+    """Check a `t=...,v1=...` Stripe-Signature header against the raw payload bytes.
+
+    Any of `secrets` may have signed the payload. Raises SignatureError if none did,
+    or if the signature timestamp is older than `tolerance` seconds.
+    """
+    if not sig_header:
+        raise SignatureError('No Stripe-Signature header')
+    if not secrets:
+        raise SignatureError('STRIPE_WEBHOOK_SECRET is not set')
+
+    timestamp = None
+    signatures = []
+    for item in sig_header.split(','):
+        key, _, value = item.strip().partition('=')
+        if key == 't':
+            timestamp = value
+        elif key == 'v1':
+            signatures.append(value)
+    if not timestamp or not signatures:
+        raise SignatureError('Unable to extract timestamp and signatures from header')
+
+    # int() also accepts non-ASCII digits, which can't be part of the signed payload
+    if not (timestamp.isascii() and timestamp.isdigit()):
+        raise SignatureError(f'Invalid signature timestamp: {timestamp!r}')
+    signed_at = int(timestamp)
+    if tolerance and signed_at < time.time() - tolerance:
+        raise SignatureError('Timestamp outside the tolerance zone')
+
+    signed_payload = timestamp.encode('ascii') + b'.' + payload
+    for secret in secrets:
+        expected = hmac.new(secret.encode('utf-8'), signed_payload, hashlib.sha256).hexdigest().encode('ascii')
+        # Compare bytes - compare_digest raises TypeError for non-ASCII str
+        if any(hmac.compare_digest(expected, signature.encode('utf-8', 'replace')) for signature in signatures):
+            return
+    raise SignatureError('No signatures found matching the expected signature for payload')
+
+
+# ---------------------------------------------------------------------------
+# Field extraction plans - EXTRACTION_RULES compiled into accessors per event type/API version
+# ---------------------------------------------------------------------------
+
+def compile_path(path):
+    """Compile a dotted path like `charges.data.0.billing_details.email` into an accessor."""
+    keys = tuple(int(part) if part.isdigit() else part for part in path.split('.'))
+
+    if len(keys) == 1:
+        key = keys[0]
+        return lambda obj: obj.get(key) if type(obj) is dict else None
+
+    def get(obj):
+        for key in keys:
+            if type(obj) is dict:
+                obj = obj.get(key)
+            elif type(obj) is list and type(key) is int and key < len(obj):
+                obj = obj[key]
+            else:
+                return None
+        return obj
+
+    return get
+
+
+@functools.lru_cache(maxsize=64)
+def compile_extraction_plan(event_type, api_version):
+    """Build the ordered (path, accessor) list for each field of an event type and API version."""
+    rules = {**EXTRACTION_DEFAULTS, **EXTRACTION_RULES.get(event_type, {})}
+    plan = {}
+    for field, paths in rules.items():
+        plan[field] = tuple(
+            (path, compile_path(path)) for path in paths
+            if not any(path.startswith(prefix) and api_version and api_version >= version
+                       for prefix, version in EXTRACTION_PATHS_REMOVED.items())
+        )
+    return plan
+
+
+def run_extraction_plan(plan, field, data):
+    """Return (value, path) for the first path of `field` with a non-empty value, or (None, None)."""
+    for path, get in plan[field]:
+        value = get(data)
+        if value:
+            return value, path
+    return None, None
+
+
+# ---------------------------------------------------------------------------
+# Sync errors - retryable (transient) vs permanent
+# ---------------------------------------------------------------------------
+
+class SyncError(Exception):
+    """A GHL sync failed. `retryable` says whether trying again later may succeed."""
+
+    def __init__(self, message, retryable=True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class CircuitOpenError(SyncError):
+    """GHL calls are being short-circuited; retry after `retry_after` seconds."""
+
+    def __init__(self, retry_after):
+        super().__init__(f'GHL circuit breaker is open - retry in {retry_after:.0f}s', retryable=True)
+        self.retry_after = retry_after
+
+
+def ghl_error(action, response):
+    """Build a SyncError for a failed GHL response: 408, 429 and 5xx are retryable."""
+    status = response.status_code
+    retryable = status in (408, 429) or status >= 500
+    return SyncError(f'{action} failed: {status} - {response.text[:500]}', retryable=retryable)
+
+
+def is_retryable(exc):
+    """Classify an exception raised while syncing an event."""
+    if isinstance(exc, SyncError):
+        return exc.retryable
+    # Network errors, timeouts and a busy database are transient
+    return isinstance(exc, (requests.ConnectionError, requests.Timeout, sqlite3.OperationalError))
+
+
+def retry_delay(attempts):
+    """Full-jitter exponential backoff for the given attempt number (1-based)."""
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempts - 1)))
+
+
+# ---------------------------------------------------------------------------
+# GHL rate limiter - token bucket shared by all threads in the process
+# ---------------------------------------------------------------------------
+
+def parse_retry_after(value):
+    """Parse a Retry-After header (seconds or HTTP date) into a delay in seconds."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimiter:
+    """Token bucket that paces GHL calls and follows GHL's rate-limit response headers.
+
+    Background callers (the contact index backfill) only take a token while more than
+    the reserved share of the bucket is left, so live syncs are never starved.
+    """
+
+    def __init__(self, burst, interval, reserve=0.0):
+        self.capacity = float(burst)
+        self.rate = burst / interval
+        self.reserve = reserve
+        self.tokens = float(burst)
+        self.blocked_until = 0.0
+        self._updated = time.monotonic()
+        self._cond = threading.Condition()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, background=False):
+        """Block until a request may be sent."""
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self.blocked_until:
+                    self._cond.wait(self.blocked_until - now)
+                    continue
+                needed = 1 + (self.capacity * self.reserve if background else 0)
+                if self.tokens >= needed:
+                    self.tokens -= 1
+                    return
+                self._cond.wait((needed - self.tokens) / self.rate)
+
+    def update(self, headers):
+        """Sync the bucket with GHL's X-RateLimit-* response headers."""
+        limit = headers.get('X-RateLimit-Max')
+        interval_ms = headers.get('X-RateLimit-Interval-Milliseconds')
+        remaining = headers.get('X-RateLimit-Remaining')
+        daily_remaining = headers.get('X-RateLimit-Daily-Remaining')
+        with self._cond:
+            try:
+                if limit and interval_ms:
+                    # GHL's limit is per location - only ever lower our per-process share
+                    self.rate = min(self.rate, float(limit) / (float(interval_ms) / 1000))
+                    self.capacity = min(self.capacity, float(limit))
+                if remaining is not None:
+                    # GHL's count is authoritative - never assume more budget than it reports
+                    self.tokens = min(self.tokens, float(remaining))
+                if daily_remaining is not None and int(daily_remaining) <= 0:
+                    logger.error('[GHL] Daily API limit exhausted - pausing GHL calls for 15 minutes')
+                    self.blocked_until = max(self.blocked_until, time.monotonic() + 900)
+            except ValueError:
+                logger.warning(f'[GHL] Unparseable rate-limit headers: {remaining=} {limit=} {interval_ms=}')
+
+    def block(self, seconds):
+        """Stop all calls for `seconds` (e.g. after a 429 with Retry-After)."""
+        with self._cond:
+            self.tokens = 0.0
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def stats(self):
+        with self._cond:
+            self._refill(time.monotonic())
+            return {
+                'tokens': round(self.tokens, 2),
+                'capacity': self.capacity,
+                'rate_per_second': round(self.rate, 3),
+                'blocked_for': round(max(0.0, self.blocked_until - time.monotonic()), 2),
+            }
+
+
+# ---------------------------------------------------------------------------
+# GHL circuit breaker - closed -> open on a high error rate -> half-open probe -> closed
+# ---------------------------------------------------------------------------
+
+class CircuitBreaker:
+    """Rolling error-rate circuit breaker for GHL calls."""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, window, min_calls, error_rate, cooldown):
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.opened_at = 0.0
+        self._calls = deque()  # (monotonic time, succeeded)
+        self._failures = 0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def _prune(self, now):
+        while self._calls and self._calls[0][0] < now - self.window:
+            _, succeeded = self._calls.popleft()
+            if not succeeded:
+                self._failures -= 1
+
+    def before_call(self):
+        """Raise CircuitOpenError unless a call may go to GHL right now."""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            now = time.monotonic()
+            remaining = self.opened_at + self.cooldown - now
+            if self.state == self.OPEN and remaining <= 0:
+                self.state = self.HALF_OPEN
+                logger.info('[GHL] Circuit breaker half-open - sending a probe call')
+            if self.state == self.HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return
+            raise CircuitOpenError(max(remaining, 1.0))
+
+    def record(self, succeeded):
+        """Record the outcome of a call that was allowed through."""
+        with self._lock:
+            now = time.monotonic()
+            if self.state == self.HALF_OPEN:
+                self._probe_in_flight = False
+                if succeeded:
+                    logger.info('[GHL] Probe succeeded - circuit breaker closed')
+                    self.state = self.CLOSED
+                    self._calls.clear()
+                    self._failures = 0
+                else:
+                    logger.warning('[GHL] Probe failed - circuit breaker re-opened')
+                    self.state = self.OPEN
+                    self.opened_at = now
+                return
+
+            self._calls.append((now, succeeded))
+            if not succeeded:
+                self._failures += 1
+            self._prune(now)
+            if (self.state == self.CLOSED and len(self._calls) >= self.min_calls
+                    and self._failures / len(self._calls) >= self.error_rate):
+                logger.error(f'[GHL] Circuit breaker opened: {self._failures}/{len(self._calls)} calls '
+                             f'failed in the last {self.window:.0f}s')
+                self.state = self.OPEN
+                self.opened_at = now
+
+    def stats(self):
+        with self._lock:
+            self._prune(time.monotonic())
+            return {
+                'state': self.state,
+                'calls': len(self._calls),
+                'failures': self._failures,
+                'open_for': round(max(0.0, self.opened_at + self.cooldown - time.monotonic()), 1)
+                if self.state == self.OPEN else 0.0,
+            }
+
+
+# ---------------------------------------------------------------------------
+# GHL API client - one pooled keep-alive session shared by all threads in the process
+# ---------------------------------------------------------------------------
+
+class GHLClient:
+    """Thin wrapper around a pooled requests.Session for the GHL v2 API."""
+
+    def __init__(self, api_key, base_url=GHL_BASE_URL, pool_size=None,
+                 timeout=(GHL_CONNECT_TIMEOUT, GHL_READ_TIMEOUT), rate_limiter=None, breaker=None):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter
+        self.breaker = breaker
+        self.pool_size = pool_size or QUEUE_WORKERS + 2
+
+        # A single host, so one pool; block instead of opening throwaway connections when it's full
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, pool_block=True)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.headers.update({
+            'Authorization': f'Bearer {api_key}',
+            'Content-Type': 'application/json',
+            'Accept': 'application/json',
+            'Version': GHL_API_VERSION,
+        })
+
+    def request(self, method, path, background=False, **kwargs):
+        """Send a request to the GHL API. `path` is relative to the base URL.
+
+        Calls are paced by the rate limiter; a 429 blocks all callers for its Retry-After
+        and is retried up to GHL_MAX_429_RETRIES times before the 429 is returned.
+        While the circuit breaker is open this raises CircuitOpenError without calling GHL.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        url = f'{self.base_url}{path}'
+        for attempt in range(GHL_MAX_429_RETRIES + 1):
+            if self.breaker:
+                self.breaker.before_call()
+            if self.rate_limiter:
+                self.rate_limiter.acquire(background=background)
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except Exception:
+                if self.breaker:
+                    self.breaker.record(False)
+                raise
+            if self.breaker:
+                self.breaker.record(response.status_code < 500)
+            if self.rate_limiter:
+                self.rate_limiter.update(response.headers)
+            if response.status_code != 429 or attempt == GHL_MAX_429_RETRIES:
+                return response
+
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            if retry_after is None:
+                retry_after = GHL_RATE_LIMIT_INTERVAL
+            logger.warning(f'[GHL] 429 on {method} {path} - retrying in {retry_after:.1f}s')
+            if self.rate_limiter:
+                self.rate_limiter.block(retry_after)
+            else:
+                time.sleep(retry_after)
+        return response
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.request('PUT', path, **kwargs)
+
+    def warm(self, connections=GHL_WARM_CONNECTIONS):
+        """Open `connections` keep-alive connections up front so the first syncs skip the TLS handshake."""
+        def _open():
+            try:
+                self.session.head(self.base_url, timeout=self.timeout)
+            except requests.RequestException as e:
+                logger.warning(f'[GHL] Connection warm-up failed: {e}')
+
+        threads = [threading.Thread(target=_open, daemon=True) for _ in range(min(connections, self.pool_size))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        logger.info(f'[GHL] Warmed {len(threads)} connections (pool size {self.pool_size})')
+
+
+ghl = GHLClient(
+    GHL_API_KEY,
+    pool_size=GHL_POOL_SIZE,
+    rate_limiter=RateLimiter(GHL_RATE_LIMIT_BURST, GHL_RATE_LIMIT_INTERVAL, GHL_RATE_LIMIT_RESERVE),
+    breaker=CircuitBreaker(GHL_BREAKER_WINDOW, GHL_BREAKER_MIN_CALLS, GHL_BREAKER_ERROR_RATE, GHL_BREAKER_COOLDOWN),
+)
+
+
+# ---------------------------------------------------------------------------
+# Custom field schema - our field keys resolved to the location's custom field IDs
+# ---------------------------------------------------------------------------
+
+class CustomFieldSchema:
+    """Cache of the location's contact custom field definitions, mapping field keys to IDs."""
+
+    def __init__(self, refresh_interval, retry_interval):
+        self.refresh_interval = refresh_interval
+        self.retry_interval = retry_interval
+        self.field_ids = {}
+        self.loaded_at = None
+        self.failed_at = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Fetch the custom field definitions from GHL. Raises SyncError on failure."""
+        response = ghl.get(f'/locations/{GHL_LOCATION_ID}/customFields', params={'model': 'contact'})
+        if response.status_code != 200:
+            raise ghl_error('GHL custom field load', response)
+
+        field_ids = {}
+        for field in response.json().get('customFields', []):
+            # fieldKey looks like "contact.card_name"
+            key = (field.get('fieldKey') or '').split('.', 1)[-1]
+            if key and field.get('id'):
+                field_ids[key] = field['id']
+        with self._lock:
+            self.field_ids = field_ids
+            self.loaded_at = time.monotonic()
+        logger.info(f'[GHL] Loaded {len(field_ids)} custom field definitions')
+        return self.missing()
+
+    def missing(self):
+        """Return the keys in CUSTOM_FIELD_KEYS that the location doesn't define."""
+        return sorted(key for key in CUSTOM_FIELD_KEYS.values() if key not in self.field_ids)
+
+    def invalidate(self):
+        """Force a reload before the next write (e.g. after GHL rejected a field)."""
+        with self._lock:
+            self.loaded_at = None
+            self.failed_at = None
+
+    def custom_fields(self, fields):
+        """Build the customFields payload for {key: value}, addressing fields by ID when known.
+
+        Reloads the definitions first if they are stale; if that fails, falls back to keys
+        and doesn't try again for retry_interval seconds.
+        """
+        now = time.monotonic()
+        stale = self.loaded_at is None or now - self.loaded_at > self.refresh_interval
+        if stale and (self.failed_at is None or now - self.failed_at > self.retry_interval):
+            try:
+                missing = self.load()
+                self.failed_at = None
+                if missing:
+                    logger.error(f'[GHL] Custom fields missing in GHL: {missing}')
+            except (SyncError, requests.RequestException) as e:
+                self.failed_at = now
+                logger.warning(f'[GHL] Could not load custom fields, writing by key: {e}')
+
+        payload = []
+        for key, value in fields.items():
+            field_id = self.field_ids.get(key)
+            if field_id:
+                payload.append({'id': field_id, 'field_value': value})
+            else:
+                payload.append({'key': key, 'field_value': value})
+        return payload
+
+    def stats(self):
+        return {
+            'loaded': self.loaded_at is not None,
+            'fields': len(self.field_ids),
+            'missing': self.missing() if self.loaded_at is not None else None,
+        }
+
+
+custom_field_schema = CustomFieldSchema(CUSTOM_FIELD_REFRESH, CUSTOM_FIELD_RETRY)
+
+
+# ---------------------------------------------------------------------------
+# Spend ledger - payments per contact with running totals, written with group commit
+# ---------------------------------------------------------------------------
+
+class SpendLedger:
+    """Records payments per contact and keeps each contact's running spend total.
+
+    Payments are keyed by payment intent ID, so recording one twice doesn't change the
+    total. Recording a payment against a different contact (the first one was deleted or
+    merged in GHL) moves it to the new contact. Writes from all threads are handed to a
+    single writer thread, which commits everything that queued up while the previous
+    transaction ran in one transaction.
+    """
+
+    def __init__(self):
+        self._pending = []
+        self._cond = threading.Condition()
+        self._writer = None
+
+    def record(self, payment_id, contact_id, amount_cents):
+        """Record a payment (once) and return the contact's total spend in cents."""
+        done = threading.Event()
+        entry = {'args': (payment_id, contact_id, amount_cents), 'done': done}
+        with self._cond:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._run, name='ledger-writer', daemon=True)
+                self._writer.start()
+            self._pending.append(entry)
+            self._cond.notify()
+        done.wait()
+        if 'error' in entry:
+            raise entry['error']
+        return entry['total']
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                batch, self._pending = self._pending, []
+            self._commit(batch)
+
+    def _commit(self, batch):
+        now = time.time()
+        try:
+            with db_transaction() as conn:
+                for entry in batch:
+                    payment_id, contact_id, amount_cents = entry['args']
+                    recorded = conn.execute(
+                        'SELECT contact_id, amount_cents FROM payments WHERE payment_id = ?', (payment_id,)
+                    ).fetchone()
+                    if recorded is not None and recorded['contact_id'] != contact_id:
+                        # Recorded against a contact that has since been deleted or merged - move it
+                        conn.execute(
+                            'UPDATE contact_totals SET total_cents = total_cents - ?, '
+                            'payment_count = payment_count - 1, updated_at = ? WHERE contact_id = ?',
+                            (recorded['amount_cents'], now, recorded['contact_id'])
+                        )
+                        conn.execute('DELETE FROM payments WHERE payment_id = ?', (payment_id,))
+                        amount_cents, recorded = recorded['amount_cents'], None
+                    if recorded is None:
+                        conn.execute(
+                            'INSERT INTO payments (payment_id, contact_id, amount_cents, recorded_at) '
+                            'VALUES (?, ?, ?, ?)',
+                            (payment_id, contact_id, amount_cents, now)
+                        )
+                        conn.execute(
+                            'INSERT INTO contact_totals (contact_id, total_cents, payment_count, updated_at) '
+                            'VALUES (?, ?, 1, ?) ON CONFLICT(contact_id) DO UPDATE SET '
+                            'total_cents = total_cents + excluded.total_cents, '
+                            'payment_count = payment_count + 1, updated_at = excluded.updated_at',
+                            (contact_id, amount_cents, now)
+                        )
+                    row = conn.execute(
+                        'SELECT total_cents FROM contact_totals WHERE contact_id = ?', (contact_id,)
+                    ).fetchone()
+                    entry['total'] = row['total_cents'] if row else 0
+        except Exception as e:
+            for entry in batch:
+                entry['error'] = e
+        for entry in batch:
+            entry['done'].set()
+
+    def total(self, contact_id):
+        """Return a contact's recorded total spend in cents."""
+        row = get_db().execute(
+            'SELECT total_cents FROM contact_totals WHERE contact_id = ?', (contact_id,)
+        ).fetchone()
+        return row['total_cents'] if row else 0
+
+
+spend_ledger = SpendLedger()
+
+
+# ---------------------------------------------------------------------------
+# Contact field state - hash of the last value written to each custom field
+# ---------------------------------------------------------------------------
+
+def field_hash(value):
+    """Content hash of a custom field value."""
+    return hashlib.sha1(str(value).encode('utf-8')).hexdigest()
+
+
+def changed_fields(contact_id, fields):
+    """Return the subset of `fields` (GHL key -> value) that differs from what was last written."""
+    rows = get_db().execute(
+        'SELECT field_key, value_hash FROM contact_fields WHERE contact_id = ? AND updated_at > ?',
+        (contact_id, time.time() - FIELD_STATE_TTL)
+    ).fetchall()
+    written = {r['field_key']: r['value_hash'] for r in rows}
+    return {key: value for key, value in fields.items() if written.get(key) != field_hash(value)}
+
+
+def record_written_fields(contact_id, fields):
+    """Remember the values just written to a contact."""
+    now = time.time()
+    get_db().executemany(
+        'INSERT OR REPLACE INTO contact_fields (contact_id, field_key, value_hash, updated_at) '
+        'VALUES (?, ?, ?, ?)',
+        [(contact_id, key, field_hash(value), now) for key, value in fields.items()]
+    )
+
+
+def last_event_created(contact_id):
+    """Return the Stripe `created` time of the newest event whose billing data was written, or None.
+
+    Marks are kept per contact ID and also per ``email:<normalized email>``, so that the
+    upsert path can check an event before it knows the contact ID.
+    """
+    row = get_db().execute(
+        'SELECT event_created FROM contact_high_water WHERE contact_id = ?', (contact_id,)
+    ).fetchone()
+    return row['event_created'] if row else None
+
+
+def record_event_created(contact_id, created, email=None):
+    """Advance a contact's (and its email's) high-water mark to `created`; marks never move backwards."""
+    now = time.time()
+    keys = [contact_id] + ([f'email:{normalize_email(email)}'] if email else [])
+    get_db().executemany(
+        'INSERT INTO contact_high_water (contact_id, event_created, updated_at) VALUES (?, ?, ?) '
+        'ON CONFLICT(contact_id) DO UPDATE SET '
+        'event_created = MAX(event_created, excluded.event_created), updated_at = excluded.updated_at',
+        [(key, created, now) for key in keys]
+    )
+
+
+# ---------------------------------------------------------------------------
+# Contact cache - normalized email -> GHL contactId (or NO_CONTACT for unknown emails)
+# ---------------------------------------------------------------------------
+
+NO_CONTACT = ''
+
+contact_cache = LRUCache(CONTACT_CACHE_SIZE, ttl=CONTACT_CACHE_TTL)
+
+# In-flight GHL lookups/upserts per email, shared by every thread that needs the same one
+contact_lookups = SingleFlight()
+
+
+def normalize_email(email):
+    """Normalize an email for use as a cache key."""
+    return email.strip().lower()
+
+
+# ---------------------------------------------------------------------------
+# Contact index - local copy of the location's email -> contactId mapping
+# ---------------------------------------------------------------------------
+
+class ContactIndex:
+    """Email -> contact ID for every contact in the location, kept in the sync database.
+
+    Built by paging through POST /contacts/search sorted by dateUpdated, one page in memory
+    at a time; later refreshes only fetch contacts updated since the last one. An email
+    missing from the index may still exist in GHL (created since the last refresh), so a
+    miss falls through to a live lookup.
+    """
+
+    WATERMARK = 'contact_index.watermark'
+    CLAIMED_AT = 'contact_index.claimed_at'
+
+    def __init__(self, page_size):
+        self.page_size = page_size
+        self.refreshed_at = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, email, count=True):
+        """Return the indexed contact ID for a normalized email, or None."""
+        row = get_db().execute('SELECT contact_id FROM contact_index WHERE email = ?', (email,)).fetchone()
+        if row is None:
+            self.misses += count
+            return None
+        self.hits += count
+        return row['contact_id']
+
+    def apply(self, conn, contacts):
+        """Write a page of GHL contacts to the index. Returns the latest dateUpdated seen."""
+        latest = None
+        for contact in contacts:
+            contact_id = contact.get('id')
+            if not contact_id:
+                continue
+            date_updated = contact.get('dateUpdated')
+            self.put(conn, contact_id, contact.get('email'), date_updated)
+            if date_updated and (latest is None or date_updated > latest):
+                latest = date_updated
+        return latest
+
+    def put(self, conn, contact_id, email, date_updated=None):
+        """Point a contact's (normalized) email at it, dropping any email it had before.
+
+        Returns the emails that no longer map to the contact, or None if the change is
+        older than what's already indexed for the contact and was ignored.
+        """
+        email = normalize_email(email or '')
+        rows = conn.execute(
+            'SELECT email, date_updated FROM contact_index WHERE contact_id = ?', (contact_id,)
+        ).fetchall()
+        if date_updated and any(r['date_updated'] and r['date_updated'] > date_updated for r in rows):
+            return None
+        stale = [r['email'] for r in rows if r['email'] != email]
+        if stale:
+            conn.execute('DELETE FROM contact_index WHERE contact_id = ? AND email != ?', (contact_id, email))
+        if email:
+            conn.execute(
+                'INSERT INTO contact_index (email, contact_id, date_updated) VALUES (?, ?, ?) '
+                'ON CONFLICT(email) DO UPDATE SET contact_id = excluded.contact_id, '
+                'date_updated = excluded.date_updated',
+                (email, contact_id, date_updated)
+            )
+        return stale
+
+    def remove(self, conn, contact_id):
+        """Drop a deleted contact from the index. Returns the emails that pointed at it."""
+        rows = conn.execute('SELECT email FROM contact_index WHERE contact_id = ?', (contact_id,)).fetchall()
+        conn.execute('DELETE FROM contact_index WHERE contact_id = ?', (contact_id,))
+        return [r['email'] for r in rows]
+
+    def refresh(self, full=False):
+        """Fetch contacts updated since the last refresh (or all of them). Returns the count."""
+        row = get_db().execute('SELECT value FROM sync_state WHERE name = ?', (self.WATERMARK,)).fetchone()
+        watermark = None if full or row is None else row['value']
+        mode = 'incremental' if watermark else 'full'
+
+        body = {
+            'locationId': GHL_LOCATION_ID,
+            'pageLimit': self.page_size,
+            'sort': [{'field': 'dateUpdated', 'direction': 'asc'}],
+        }
+        if watermark:
+            # Inclusive, so contacts sharing the watermark's timestamp aren't skipped
+            body['filters'] = [{'field': 'dateUpdated', 'operator': 'range', 'value': {'gte': watermark}}]
+
+        started = time.monotonic()
+        count = 0
+        while True:
+            response = ghl.post('/contacts/search', json=body, background=True)
+            if response.status_code != 200:
+                raise ghl_error('GHL contact search', response)
+            contacts = response.json().get('contacts', [])
+            if not contacts:
+                break
+
+            with db_transaction() as conn:
+                latest = self.apply(conn, contacts)
+                if latest and (watermark is None or latest > watermark):
+                    watermark = latest
+                    conn.execute(
+                        'INSERT INTO sync_state (name, value) VALUES (?, ?) '
+                        'ON CONFLICT(name) DO UPDATE SET value = excluded.value',
+                        (self.WATERMARK, watermark)
+                    )
+            count += len(contacts)
+
+            if len(contacts) < self.page_size or not contacts[-1].get('searchAfter'):
+                break
+            body['searchAfter'] = contacts[-1]['searchAfter']
+
+        self.refreshed_at = time.time()
+        logger.info(f'[Index] Indexed {count} contacts ({mode}) in {time.monotonic() - started:.1f}s')
+        return count
+
+    def claim_refresh(self, interval):
+        """Return True if this process should run the next refresh (one process per interval)."""
+        now = time.time()
+        with db_transaction() as conn:
+            row = conn.execute('SELECT value FROM sync_state WHERE name = ?', (self.CLAIMED_AT,)).fetchone()
+            if row is not None and now - float(row['value']) < interval:
+                return False
+            conn.execute(
+                'INSERT INTO sync_state (name, value) VALUES (?, ?) '
+                'ON CONFLICT(name) DO UPDATE SET value = excluded.value',
+                (self.CLAIMED_AT, str(now))
+            )
+        return True
+
+    def run(self, interval):
+        """Refresh the index every `interval` seconds, sharing the work between processes."""
+        while True:
+            try:
+                if self.claim_refresh(interval):
+                    self.refresh()
+            except (SyncError, requests.RequestException, sqlite3.Error) as e:
+                logger.warning(f'[Index] Contact index refresh failed: {e}')
+            time.sleep(interval)
+
+    def stats(self):
+        row = get_db().execute('SELECT COUNT(*) AS n FROM contact_index').fetchone()
+        return {'contacts': row['n'], 'hits': self.hits, 'misses': self.misses,
+                'refreshed_at': self.refreshed_at}
+
+
+contact_index = ContactIndex(CONTACT_INDEX_PAGE_SIZE)
+
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint for Railway."""
-    return jsonify({'status': 'healthy'}), 200
+    breaker = ghl.breaker.stats()
+    return jsonify({
+        'status': 'healthy' if breaker['state'] == CircuitBreaker.CLOSED else 'degraded',
+        'circuit_breaker': breaker,
+        'contact_cache': contact_cache.stats(),
+        'shared_lookups': contact_lookups.shared,
+        'rate_limiter': ghl.rate_limiter.stats(),
+        'pending_timers': len(retry_timer),
+        'custom_fields': custom_field_schema.stats(),
+        'contact_index': contact_index.stats(),
+    }), 200
+
+
+@app.route('/ghl/webhook', methods=['POST'])
+def ghl_webhook():
+    """Apply GHL contact webhooks to the contact index and cache."""
+    # Unauthenticated updates could point any email at any contact, so a token is required
+    if not GHL_WEBHOOK_TOKEN:
+        logger.error('GHL webhook received but GHL_WEBHOOK_TOKEN is not set - rejecting it')
+        return jsonify({'error': 'GHL webhooks are not enabled'}), 403
+    token = request.args.get('token', '').encode('utf-8')
+    if not hmac.compare_digest(token, GHL_WEBHOOK_TOKEN.encode('utf-8')):
+        return jsonify({'error': 'Invalid token'}), 401
+
+    event = request.get_json(silent=True)
+    if not isinstance(event, dict):
+        return jsonify({'error': 'Invalid payload'}), 400
+    event_type = event.get('type')
+    if event_type not in GHL_CONTACT_EVENTS or event.get('locationId') != GHL_LOCATION_ID:
+        return jsonify({'received': True}), 200
+
+    contact_id = event.get('id')
+    if not contact_id:
+        return jsonify({'error': 'Invalid payload'}), 400
+
+    # Another process could be holding the write lock - let GHL retry rather than block
+    try:
+        apply_contact_webhook(event_type, contact_id, event)
+    except sqlite3.Error as e:
+        logger.error(f'Could not apply GHL {event_type} for {contact_id}: {e}')
+        return jsonify({'error': 'Could not apply event'}), 500
+    return jsonify({'received': True}), 200
+
+
+def apply_contact_webhook(event_type, contact_id, event):
+    """Update the contact index and cache from a GHL contact webhook."""
+    email = normalize_email(event.get('email') or '')
+    deleted = event_type == 'ContactDelete'
+    with db_transaction() as conn:
+        if deleted:
+            removed = contact_index.remove(conn, contact_id)
+            conn.execute('DELETE FROM contact_fields WHERE contact_id = ?', (contact_id,))
+            marks = [contact_id] + [f'email:{e}' for e in {*removed, email} if e]
+            conn.executemany('DELETE FROM contact_high_water WHERE contact_id = ?', [(key,) for key in marks])
+        else:
+            removed = contact_index.put(conn, contact_id, email, event.get('dateUpdated'))
+            if removed is None:
+                log_stage(logging.DEBUG, 'contact', None, type=event_type, contact_id=contact_id,
+                          action='ignored', reason='older than indexed')
+                return
+            # Contacts merged into this one are gone; their emails now resolve here
+            for merged_id in event.get('mergedContactIds') or []:
+                removed += contact_index.remove(conn, merged_id)
+
+    for old_email in removed:
+        contact_cache.pop(old_email)
+    if deleted:
+        # The cache can also hold the contact from a live lookup the index never saw
+        if email and contact_cache.get(email) == contact_id:
+            contact_cache.pop(email)
+    elif email:
+        contact_cache.set(email, contact_id)
+    log_stage(logging.INFO, 'contact', None, type=event_type, contact_id=contact_id,
+              email=email or None, removed=removed or None)
 
 
 @app.route('/webhook', methods=['POST'])
@@ -50,299 +1683,653 @@ def stripe_webhook():
     payload = request.get_data()
     sig_header = request.headers.get('Stripe-Signature')
 
-    logger.info('=' * 60)
-    logger.info('WEBHOOK RECEIVED')
-    logger.info('=' * 60)
-
-    # Verify webhook signature
+    # Verify webhook signature on the raw bytes, then decode the event once into plain dicts
     try:
-        event = stripe.Webhook.construct_event(
-            payload, sig_header, STRIPE_WEBHOOK_SECRET
-        )
-    except ValueError as e:
-        logger.error(f'Invalid payload: {e}')
-        return jsonify({'error': 'Invalid payload'}), 400
-    except stripe.error.SignatureVerificationError as e:
+        verify_stripe_signature(payload, sig_header, STRIPE_WEBHOOK_SECRETS)
+    except SignatureError as e:
         logger.error(f'Invalid signature: {e}')
         return jsonify({'error': 'Invalid signature'}), 400
 
-    # Log event details
-    event_type = event['type']
-    event_id = event.get('id', 'unknown')
-    logger.info(f'Event ID: {event_id}')
-    logger.info(f'Event Type: {event_type}')
+    # Most events are types we ignore - acknowledge those without decoding or logging them
+    if not HANDLED_TYPE_PATTERN.search(payload):
+        return jsonify({'received': True}), 200
 
-    if event_type in ['checkout.session.completed', 'payment_intent.succeeded', 'charge.succeeded']:
-        handle_payment_event(event)
-    else:
-        logger.info(f'Ignoring event type: {event_type}')
+    try:
+        event = json.loads(payload)
+        event_type = event['type']
+        event_id = event['id']
+    except (ValueError, KeyError, TypeError) as e:
+        logger.error(f'Invalid payload: {e!r}')
+        return jsonify({'error': 'Invalid payload'}), 400
 
-    # Always return 200 to prevent Stripe retries
-    return jsonify({'received': True}), 200
+    if event_type not in HANDLED_EVENT_TYPES:
+        # The pre-filter matched a handled type name somewhere other than the top-level type
+        log_stage(logging.DEBUG, 'received', event_id, type=event_type, action='ignored')
+        return jsonify({'received': True}), 200
 
+    # Stripe delivers at least once - skip events we've already synced
+    try:
+        if get_event_state(event_id) == EVENT_PROCESSED:
+            log_stage(logging.INFO, 'received', event_id, type=event_type, action='duplicate')
+            return jsonify({'received': True}), 200
+    except sqlite3.Error as e:
+        logger.error(f'Could not check idempotency state for {event_id}: {e}')
 
-def handle_payment_event(event):
-    """Process payment events and sync to GHL."""
+    # Store the raw event and acknowledge - GHL sync happens in the queue workers.
+    # If the event can't be stored, return 500 so Stripe retries the delivery.
     try:
-        event_type = event['type']
-        data = event['data']['object']
+        correlation_key = payment_correlation_key(event)
+        contact_key, email = contact_reference(event)
+        queued = enqueue_event(event_id, event_type, payload, correlation_key, email=email, contact_key=contact_key)
+        log_stage(logging.INFO, 'received', event_id, type=event_type, payment=correlation_key,
+                  action='queued' if queued else 'already_queued', bytes=len(payload))
+    except sqlite3.Error as e:
+        logger.error(f'Could not queue event {event_id}: {e}')
+        return jsonify({'error': 'Could not queue event'}), 500
 
-        logger.info('-' * 40)
-        logger.info('PROCESSING PAYMENT EVENT')
-        logger.info('-' * 40)
+    return jsonify({'received': True}), 200
 
-        # Log all available top-level keys in the data object
-        logger.info(f'Available data keys: {list(data.keys())}')
 
-        # Log metadata - this often contains contactId from GHL
-        metadata = data.get('metadata', {})
-        logger.info(f'[Metadata] {safe_json(metadata)}')
+def payment_correlation_key(event):
+    """Return the payment intent ID shared by all events for one payment, or None."""
+    plan = compile_extraction_plan(event['type'], event.get('api_version'))
+    payment_id, _ = run_extraction_plan(plan, 'payment_id', event['data']['object'])
+    return payment_id if isinstance(payment_id, str) else None
 
-        # Check for GHL contactId in metadata FIRST (most reliable method)
-        contact_id = metadata.get('contactId')
-        if contact_id:
-            logger.info(f'[Contact] Found contactId in metadata: {contact_id}')
-        else:
-            logger.info('[Contact] No contactId in metadata')
-
-        # Log key fields for debugging
-        logger.debug(f'Full event data:\n{safe_json(data)}')
-
-        # Extract customer email from various possible locations (as fallback)
-        email = None
-        email_source = None
-
-        # 1. checkout.session.completed: customer_details.email
-        if 'customer_details' in data and data['customer_details']:
-            cd_email = data['customer_details'].get('email')
-            logger.info(f'[Email Check 1] customer_details.email: {cd_email}')
-            if cd_email and not email:
-                email = cd_email
-                email_source = 'customer_details.email'
-
-        # 2. payment_intent: receipt_email
-        receipt_email = data.get('receipt_email')
-        logger.info(f'[Email Check 2] receipt_email: {receipt_email}')
-        if receipt_email and not email:
-            email = receipt_email
-            email_source = 'receipt_email'
-
-        # 3. payment_intent: billing_details.email (direct)
-        if 'billing_details' in data and data['billing_details']:
-            bd_email = data['billing_details'].get('email')
-            logger.info(f'[Email Check 3] billing_details.email: {bd_email}')
-            if bd_email and not email:
-                email = bd_email
-                email_source = 'billing_details.email'
-
-        # 4. payment_intent: charges.data[0].billing_details.email
-        if 'charges' in data and data['charges'].get('data'):
-            charges = data['charges']['data']
-            if charges and charges[0].get('billing_details'):
-                charge_email = charges[0]['billing_details'].get('email')
-                logger.info(f'[Email Check 4] charges[0].billing_details.email: {charge_email}')
-                if charge_email and not email:
-                    email = charge_email
-                    email_source = 'charges[0].billing_details.email'
-        else:
-            logger.info('[Email Check 4] charges.data: not present')
-
-        # 5. payment_intent: latest_charge.billing_details.email (if expanded)
-        if 'latest_charge' in data:
-            if isinstance(data['latest_charge'], dict):
-                lc = data['latest_charge']
-                if lc.get('billing_details'):
-                    lc_email = lc['billing_details'].get('email')
-                    logger.info(f'[Email Check 5] latest_charge.billing_details.email: {lc_email}')
-                    if lc_email and not email:
-                        email = lc_email
-                        email_source = 'latest_charge.billing_details.email'
-            else:
-                logger.info(f'[Email Check 5] latest_charge is string ID: {data["latest_charge"]}')
-        else:
-            logger.info('[Email Check 5] latest_charge: not present')
-
-        # 6. Check for customer object or customer email
-        if 'customer_email' in data:
-            cust_email = data.get('customer_email')
-            logger.info(f'[Email Check 6] customer_email: {cust_email}')
-            if cust_email and not email:
-                email = cust_email
-                email_source = 'customer_email'
-
-        logger.info('=' * 40)
-        if contact_id:
-            logger.info(f'USING CONTACT ID FROM METADATA: {contact_id}')
-        elif email:
-            logger.info(f'EMAIL FOUND: {email}')
-            logger.info(f'Source: {email_source}')
-        else:
-            logger.error('NO CONTACT ID OR EMAIL FOUND')
-            logger.error('Cannot process payment - need either contactId in metadata or email')
-            return
-        logger.info('=' * 40)
 
-        # Extract billing details from various sources
-        billing_details = {}
+def contact_reference(event):
+    """Return (contact key, email to resolve) for a payment event.
+
+    The contact key (``id:<contactId>`` or ``email:<normalized email>``) groups a contact's
+    queued events and picks their queue shard; the email is None when the event has a
+    contactId and needs no lookup. A contact whose events sometimes carry the contactId
+    and sometimes only the email (e.g. Checkout Session vs PaymentIntent metadata) gets
+    two keys, which are sharded separately - ordering is only guaranteed per key.
+    """
+    plan = compile_extraction_plan(event['type'], event.get('api_version'))
+    data = event['data']['object']
+    contact_id, _ = run_extraction_plan(plan, 'contact_id', data)
+    if contact_id:
+        return f'id:{contact_id}', None
+    email, _ = run_extraction_plan(plan, 'email', data)
+    if not isinstance(email, str) or not email.strip():
+        return None, None
+    email = normalize_email(email)
+    return f'email:{email}', email
+
+
+def extract_payment_data(event):
+    """Extract the GHL contact reference and billing data from one payment event.
+
+    Returns None if the event has neither a contactId nor an email.
+    """
+    data = event['data']['object']
+    event_id = event.get('id')
+    plan = compile_extraction_plan(event['type'], event.get('api_version'))
+    logger.debug('[%s] Full event data:\n%s', event_id, Lazy(safe_json, data))
+
+    # contactId in metadata is the most reliable reference; the email is the fallback
+    contact_id, _ = run_extraction_plan(plan, 'contact_id', data)
+    email, email_source = run_extraction_plan(plan, 'email', data)
+    if not contact_id and not email:
+        log_stage(logging.ERROR, 'extract', event_id, error='no contactId in metadata and no email',
+                  data_keys=Lazy(list, data))
+        return None
+
+    name, billing_source = run_extraction_plan(plan, 'name', data)
+    address, _ = run_extraction_plan(plan, 'address', data)
+    if not isinstance(address, dict):
         address = {}
-        billing_source = 'none'
-
-        # Try billing_details first
-        if data.get('billing_details'):
-            billing_details = data['billing_details']
-            address = billing_details.get('address', {}) or {}
-            billing_source = 'billing_details'
-            logger.info(f'[Billing] Found in billing_details: {safe_json(billing_details)}')
-
-        # Try charges array for payment_intent
-        if not billing_details.get('name') and 'charges' in data and data['charges'].get('data'):
-            charges = data['charges']['data']
-            if charges and charges[0].get('billing_details'):
-                billing_details = charges[0]['billing_details']
-                address = billing_details.get('address', {}) or {}
-                billing_source = 'charges[0].billing_details'
-                logger.info(f'[Billing] Found in charges[0]: {safe_json(billing_details)}')
-
-        # Try customer_details for checkout.session
-        if not billing_details.get('name') and 'customer_details' in data:
-            customer_details = data.get('customer_details', {}) or {}
-            billing_details['name'] = customer_details.get('name')
-            if not address:
-                address = customer_details.get('address', {}) or {}
-            billing_source = 'customer_details'
-            logger.info(f'[Billing] Found in customer_details: {safe_json(customer_details)}')
-
-        logger.info(f'[Billing] Final source: {billing_source}')
-        logger.info(f'[Billing] Name: {billing_details.get("name", "NOT FOUND")}')
-        logger.info(f'[Billing] Address: {safe_json(address)}')
-
-        # Extract amount and convert from cents to dollars
-        amount_cents = data.get('amount_total') or data.get('amount') or 0
-        amount_dollars = f"{amount_cents / 100:.2f}"
-        logger.info(f'[Amount] Cents: {amount_cents} -> Dollars: ${amount_dollars}')
-
-        # Prepare data for GHL
-        ghl_data = {
-            'name': billing_details.get('name', ''),
-            'address_line_1': address.get('line1', ''),
-            'address_line_2': address.get('line2', ''),
-            'city': address.get('city', ''),
-            'state': address.get('state', ''),
-            'country': address.get('country', ''),
-            'amount': amount_dollars
-        }
 
-        logger.info('-' * 40)
-        logger.info('DATA TO SEND TO GHL:')
-        logger.info(f'Contact ID: {contact_id}')
-        logger.info(f'Email (fallback): {email}')
-        logger.info(f'GHL Data: {safe_json(ghl_data)}')
-        logger.info('-' * 40)
+    # Extract amount and convert from cents to dollars
+    amount_cents, _ = run_extraction_plan(plan, 'amount', data)
+    amount_dollars = f"{(amount_cents or 0) / 100:.2f}"
+
+    # Prepare data for GHL
+    ghl_data = {
+        'name': name or '',
+        'address_line_1': address.get('line1') or '',
+        'address_line_2': address.get('line2') or '',
+        'city': address.get('city') or '',
+        'state': address.get('state') or '',
+        'country': address.get('country') or '',
+        'amount': amount_dollars
+    }
 
-        # Sync to GHL - prefer contact_id, fallback to email lookup
-        sync_to_ghl(ghl_data, contact_id=contact_id, email=email)
+    log_stage(logging.INFO, 'extract', event_id, type=event['type'], contact_id=contact_id,
+              email=email, email_source=email_source, billing_source=billing_source,
+              amount=amount_dollars)
+    logger.debug('[%s] GHL data: %s', event_id, Lazy(safe_json, ghl_data))
+
+    payment_id, _ = run_extraction_plan(plan, 'payment_id', data)
+    return {
+        'event_id': event_id,
+        'event_type': event['type'],
+        'created': event.get('created'),
+        'payment_id': payment_id if isinstance(payment_id, str) else None,
+        'contact_id': contact_id,
+        'email': email,
+        'amount_cents': int(amount_cents or 0),
+        'ghl_data': ghl_data,
+    }
+
+
+# Billing fields merged across coalesced events - the amount is handled separately
+BILLING_FIELDS = ('name', 'address_line_1', 'address_line_2', 'city', 'state', 'country')
+
+
+def merge_payment_data(records):
+    """Merge the extracted data of several events for the same payment into one record.
+
+    Billing fields come from the record with the most populated fields, with gaps
+    filled from the others; the first contactId and email found win.
+    """
+    richest = max(records, key=lambda r: sum(1 for f in BILLING_FIELDS if r['ghl_data'].get(f)))
+    ordered = [richest] + [r for r in records if r is not richest]
+
+    ghl_data = {}
+    for field in BILLING_FIELDS:
+        ghl_data[field] = next((r['ghl_data'][field] for r in ordered if r['ghl_data'].get(field)), '')
+    amount_cents = max(r['amount_cents'] for r in records)
+    ghl_data['amount'] = f"{amount_cents / 100:.2f}"
+
+    return {
+        'event_id': richest['event_id'],
+        'event_type': richest['event_type'],
+        'created': max((r['created'] for r in records if r['created']), default=None),
+        'payment_id': next((r['payment_id'] for r in ordered if r['payment_id']), None),
+        'contact_id': next((r['contact_id'] for r in ordered if r['contact_id']), None),
+        'email': next((r['email'] for r in ordered if r['email']), None),
+        'amount_cents': amount_cents,
+        'ghl_data': ghl_data,
+    }
+
+
+def merge_contact_updates(payments):
+    """Fold several payments for one contact into a single update.
+
+    Billing fields come from the most recent payment that has any; the amount is the sum
+    of all of them.
+    """
+    ordered = sorted(payments, key=lambda p: p['created'] or 0, reverse=True)
+    latest = next((p for p in ordered if any(p['ghl_data'].get(f) for f in BILLING_FIELDS)), ordered[0])
+    amount_cents = sum(p['amount_cents'] for p in payments)
+    return {
+        **latest,
+        'contact_id': next((p['contact_id'] for p in ordered if p['contact_id']), None),
+        'email': next((p['email'] for p in ordered if p['email']), None),
+        'amount_cents': amount_cents,
+        'ghl_data': {**latest['ghl_data'], 'amount': f'{amount_cents / 100:.2f}'},
+    }
 
-    except Exception as e:
-        logger.error(f'Error processing payment event: {e}')
-        import traceback
-        logger.error(f'Traceback:\n{traceback.format_exc()}')
 
+def handle_payment_events(events):
+    """Process events for one contact (one or more payments) and send a single GHL update.
 
-def sync_to_ghl(data, contact_id=None, email=None):
-    """Update contact in GHL. Uses contact_id if provided, otherwise looks up by email."""
-    logger.info('-' * 40)
-    logger.info('SYNCING TO GHL')
-    logger.info('-' * 40)
+    Returns the merged data of each payment that was synced, or an empty list if the
+    events carry no contact reference. GHL failures are raised as SyncError.
+    """
+    records = [r for r in (extract_payment_data(e) for e in events) if r]
+    if not records:
+        return []
 
+    by_payment = {}
+    for record in records:
+        by_payment.setdefault(record['payment_id'] or record['event_id'], []).append(record)
+    payments = []
+    for group in by_payment.values():
+        payment = group[0] if len(group) == 1 else merge_payment_data(group)
+        if len(group) > 1:
+            log_stage(logging.INFO, 'coalesce', payment['event_id'], payment=payment['payment_id'],
+                      events=[r['event_id'] for r in group])
+        payments.append(payment)
+
+    update = payments[0] if len(payments) == 1 else merge_contact_updates(payments)
+    if len(payments) > 1:
+        log_stage(logging.INFO, 'debounce', update['event_id'], payments=[p['payment_id'] for p in payments])
+
+    # A Checkout Session without a payment intent (subscription mode) is paid by an
+    # invoice, whose charge records the spend - recording the session too would count it twice
+    spend = [(p['payment_id'] or p['event_id'], p['amount_cents']) for p in payments
+             if p['payment_id'] or p['event_type'] != 'checkout.session.completed']
+
+    # Sync to GHL - prefer contact_id, fallback to email lookup
+    sync_to_ghl(update['ghl_data'], contact_id=update['contact_id'], email=update['email'],
+                event_id=update['event_id'], created=update['created'], payments=spend)
+    return payments
+
+
+def sync_to_ghl(data, contact_id=None, email=None, event_id=None, payments=None, created=None):
+    """Update contact in GHL. Uses contact_id if provided, otherwise looks up by email.
+
+    `payments` [(payment_id, amount_cents)] are recorded in the spend ledger and total_spend
+    is written as the contact's cumulative total (an empty list writes the total as it
+    stands). Billing fields are only written if the
+    event's `created` time isn't older than the last one written for the contact. Raises
+    SyncError if the contact can't be updated.
+    """
     # Check environment variables
     if not GHL_API_KEY:
-        logger.error('GHL_API_KEY is not set!')
-        return
+        raise SyncError('GHL_API_KEY is not set!', retryable=False)
     if not GHL_LOCATION_ID:
-        logger.error('GHL_LOCATION_ID is not set!')
+        raise SyncError('GHL_LOCATION_ID is not set!', retryable=False)
+
+    # If we don't have a contact_id, look up by email
+    contact_source = 'metadata'
+    billing = True
+    if not contact_id:
+        if not email:
+            raise SyncError('No contact_id or email provided - cannot update', retryable=False)
+
+        contact_source = 'email'
+        key = normalize_email(email)
+        if GHL_UPSERT_CONTACTS and not local_contact_id(key):
+            # Upsert writes the fields too; the normal path below then only sends what's
+            # left over (total_spend if the ledger has earlier payments, or this event's
+            # fields if another thread's upsert for the email was shared)
+            contact_source = 'upsert'
+            # The contact ID isn't known yet, so check the event against the email's mark
+            email_mark = last_event_created(f'email:{key}') if created else None
+            billing = email_mark is None or created >= email_mark
+            contact_id = contact_lookups.do(
+                ('upsert', key),
+                lambda: local_contact_id(key) or upsert_contact(email, data, event_id=event_id, billing=billing))
+        else:
+            contact_id = resolve_contact_id(email, event_id=event_id)
+        if not contact_id:
+            raise SyncError(f'No GHL contact found for email: {email}', retryable=False)
+
+    # total_spend is the contact's lifetime total from the ledger, not this payment's amount
+    if payments is not None:
+        for payment_id, amount_cents in payments:
+            total_cents = spend_ledger.record(payment_id, contact_id, amount_cents or 0)
+        if not payments:
+            total_cents = spend_ledger.total(contact_id)
+        data = {**data, 'amount': f'{total_cents / 100:.2f}'}
+
+    fields = {ghl_key: data[name] for name, ghl_key in CUSTOM_FIELD_KEYS.items()}
+
+    # A late or retried event must not overwrite newer billing data - only its spend counts
+    high_water = last_event_created(contact_id) if created else None
+    stale = not billing or (high_water is not None and created < high_water)
+    if stale:
+        total_key = CUSTOM_FIELD_KEYS['amount']
+        fields = {total_key: fields[total_key]} if payments else {}
+        log_stage(logging.INFO, 'stale', event_id, contact_id=contact_id, created=created,
+                  high_water=high_water)
+
+    # Only send the custom fields that changed since the last successful write
+    changed = changed_fields(contact_id, fields)
+    if not changed:
+        log_stage(logging.INFO, 'update', event_id, contact_id=contact_id, contact_source=contact_source,
+                  action='skipped', reason='stale event' if stale else 'no field changes')
+        if created and not stale:
+            record_event_created(contact_id, created, email)
         return
 
-    logger.info(f'Location ID: {GHL_LOCATION_ID}')
-    logger.info(f'API Key: {GHL_API_KEY[:10]}...{GHL_API_KEY[-4:]}' if GHL_API_KEY else 'NOT SET')
+    # Prepare custom fields update payload (v2 format)
+    update_payload = {'customFields': custom_field_schema.custom_fields(changed)}
+    logger.debug('[%s] Update payload: %s', event_id, Lazy(safe_json, update_payload))
+
+    # Update contact
+    started = time.monotonic()
+    update_response = ghl.put(f'/contacts/{contact_id}', json=update_payload)
+    log_stage(logging.INFO, 'update', event_id, contact_id=contact_id, contact_source=contact_source,
+              fields=sorted(changed), status=update_response.status_code,
+              ms=round((time.monotonic() - started) * 1000))
+    logger.debug('[%s] Update response body: %s', event_id, Lazy(lambda: update_response.text[:1000]))
+
+    if update_response.status_code == 404 and contact_source != 'metadata':
+        # The email's cached/indexed contact was deleted or merged away - resolve it again
+        forget_contact(contact_id, email)
+        raise SyncError(f'GHL contact {contact_id} for {email} no longer exists - will look it up again',
+                        retryable=True)
+    check_update_response('GHL update', update_response, contact_id, changed)
+    record_written_fields(contact_id, changed)
+    if created and not stale:
+        record_event_created(contact_id, created, email)
+
+
+# Contact writes GHL rejected with a 422, so a repeat of the same write isn't retried again
+_rejected_writes = LRUCache(1000, ttl=24 * 3600)
 
-    headers = {
-        'Authorization': f'Bearer {GHL_API_KEY}',
-        'Content-Type': 'application/json',
-        'Version': '2021-07-28'
+
+def check_update_response(action, response, target, fields):
+    """Raise SyncError unless a write of `fields` to `target` (contact ID or email) succeeded."""
+    if response.status_code == 422:
+        # A renamed or deleted field is fixed by reloading the definitions, so retry once;
+        # if the same write is rejected again it's a value/validation error and permanent
+        write_key = (target, field_hash(sorted(fields.items())))
+        if _rejected_writes.get(write_key, count=False):
+            raise SyncError(f'{action} rejected again after reloading custom fields (422): '
+                            f'{response.text[:500]}', retryable=False)
+        _rejected_writes.set(write_key, True)
+        custom_field_schema.invalidate()
+        raise SyncError(f'{action} rejected (422): {response.text[:500]}', retryable=True)
+    if response.status_code not in (200, 201):
+        raise ghl_error(action, response)
+
+
+def upsert_contact(email, data, event_id=None, billing=True):
+    """Create or update the contact for an email with all custom fields in one call.
+
+    With billing=False (an event older than the email's last written one) no fields are
+    sent and the upsert only finds or creates the contact. Returns the contact ID and
+    caches it; raises SyncError if the upsert failed.
+    """
+    fields = {ghl_key: data[name] for name, ghl_key in CUSTOM_FIELD_KEYS.items()} if billing else {}
+    payload = {
+        'locationId': GHL_LOCATION_ID,
+        'email': email,
+        'customFields': custom_field_schema.custom_fields(fields),
     }
+    logger.debug('[%s] Upsert payload: %s', event_id, Lazy(safe_json, payload))
 
-    try:
-        # If we don't have a contact_id, look up by email
-        if not contact_id:
-            if not email:
-                logger.error('[GHL] No contact_id or email provided - cannot update')
-                return
+    started = time.monotonic()
+    response = ghl.post('/contacts/upsert', json=payload)
+    elapsed_ms = round((time.monotonic() - started) * 1000)
+    logger.debug('[%s] Upsert response body: %s', event_id, Lazy(lambda: response.text[:1000]))
+    check_update_response('GHL upsert', response, normalize_email(email), fields)
 
-            logger.info(f'[GHL] No contact_id provided, looking up by email: {email}')
-            lookup_url = f'{GHL_BASE_URL}/contacts/?locationId={GHL_LOCATION_ID}&query={email}'
-            logger.info(f'[GHL] Looking up contact: {lookup_url}')
+    result = response.json()
+    contact_id = (result.get('contact') or {}).get('id')
+    log_stage(logging.INFO, 'resolve', event_id, email=email, source='upsert', contact_id=contact_id,
+              created=result.get('new'), fields=sorted(fields), status=response.status_code, ms=elapsed_ms)
+    if not contact_id:
+        raise SyncError(f'GHL upsert returned no contact ID for {email}', retryable=True)
 
-            response = requests.get(lookup_url, headers=headers)
-            logger.info(f'[GHL] Lookup response status: {response.status_code}')
-            logger.info(f'[GHL] Lookup response body: {safe_json(response.json()) if response.status_code == 200 else response.text}')
+    contact_cache.set(normalize_email(email), contact_id)
+    record_written_fields(contact_id, fields)
+    return contact_id
 
-            if response.status_code != 200:
-                logger.error(f'[GHL] Lookup failed: {response.status_code} - {response.text}')
-                return
 
-            result = response.json()
-            contacts = result.get('contacts', [])
+def forget_contact(contact_id, email=None):
+    """Drop a contact that GHL no longer has from the contact index and cache."""
+    with db_transaction() as conn:
+        removed = contact_index.remove(conn, contact_id)
+    for key in {*removed, normalize_email(email or '')}:
+        if key and contact_cache.get(key, count=False) in (contact_id, None):
+            contact_cache.pop(key)
 
-            if not contacts:
-                logger.warning(f'[GHL] No contact found for email: {email}')
-                logger.info('[GHL] Make sure the contact exists in GHL with this exact email')
-                return
 
-            contact = contacts[0]
-            contact_id = contact.get('id')
-            logger.info(f'[GHL] Found contact via email lookup: {contact_id}')
-            logger.info(f'[GHL] Contact name: {contact.get("name", contact.get("firstName", ""))} {contact.get("lastName", "")}')
-            logger.info(f'[GHL] Contact email: {contact.get("email")}')
+def local_contact_id(key, count=True):
+    """Look a normalized email up in the contact cache, then the contact index.
+
+    Returns the contact ID, NO_CONTACT for a cached miss, or None if neither knows it.
+    count=False keeps the lookup out of the hit/miss stats (for scans that aren't real lookups).
+    """
+    cached = contact_cache.get(key, count=count)
+    if cached is not None:
+        return cached
+    indexed = contact_index.get(key, count=count)
+    if indexed:
+        contact_cache.set(key, indexed)
+    return indexed
+
+
+def resolve_contact_id(email, event_id=None):
+    """Resolve an email to a GHL contact ID, checking the contact cache and index before GHL.
+
+    Returns None if the contact doesn't exist; raises SyncError if the lookup failed.
+    """
+    key = normalize_email(email)
+    cached = local_contact_id(key)
+    if cached is not None:
+        log_stage(logging.INFO, 'resolve', event_id, email=email, source='local', contact_id=cached or None)
+        return cached or None
+
+    def lookup():
+        # A lookup that finished just before this one started has already filled the cache
+        cached = contact_cache.get(key)
+        if cached is not None:
+            return cached or None
+        # During a backlog, resolve this email together with the other queued ones
+        # (only ever an optimisation - if it fails, the exact lookup still runs)
+        if CONTACT_BATCH_SIZE > 1:
+            try:
+                found = contact_lookups.do('batch', lambda: resolve_queued_emails(key, event_id=event_id))
+            except (SyncError, requests.RequestException) as e:
+                logger.warning(f'[{event_id}] Batch contact lookup failed, looking up {email} alone: {e}')
+                found = {}
+            if key in found:
+                return found[key]
+        return lookup_contact_id(email, event_id=event_id)
+
+    return contact_lookups.do(('lookup', key), lookup)
+
+
+def resolve_queued_emails(key, event_id=None):
+    """Resolve `key` and other queued emails not known locally with one GHL contact search.
+
+    Returns {email: contact ID} for the emails found, and caches them. Emails not found
+    are left to the exact per-email lookup. Makes no request unless there's a batch.
+    """
+    rows = get_db().execute(
+        'SELECT email FROM event_queue WHERE email IS NOT NULL AND email != ? '
+        'GROUP BY email ORDER BY MIN(id) LIMIT ?',
+        (key, CONTACT_BATCH_SIZE * 2)
+    ).fetchall()
+    emails = [key] + [r['email'] for r in rows if local_contact_id(r['email'], count=False) is None]
+    emails = emails[:CONTACT_BATCH_SIZE]
+    if len(emails) < 2:
+        return {}
+
+    started = time.monotonic()
+    response = ghl.post('/contacts/search', json={
+        'locationId': GHL_LOCATION_ID,
+        'pageLimit': len(emails),
+        'filters': [{'group': 'OR', 'filters': [
+            {'field': 'email', 'operator': 'eq', 'value': email} for email in emails
+        ]}],
+    })
+    if response.status_code != 200:
+        raise ghl_error('GHL batch lookup', response)
+
+    wanted = set(emails)
+    found = {}
+    for contact in response.json().get('contacts', []):
+        email = normalize_email(contact.get('email') or '')
+        if email in wanted and contact.get('id'):
+            found[email] = contact['id']
+            contact_cache.set(email, contact['id'])
+    log_stage(logging.INFO, 'resolve', event_id, source='batch', emails=len(emails), found=len(found),
+              ms=round((time.monotonic() - started) * 1000))
+    return found
+
+
+def lookup_contact_id(email, event_id=None):
+    """Find the contact with exactly this email in GHL, caching the answer either way."""
+    key = normalize_email(email)
+    started = time.monotonic()
+    # Exact match on the email (GHL's duplicate check), not the fuzzy full-text `query=` search
+    response = ghl.get('/contacts/search/duplicate', params={'locationId': GHL_LOCATION_ID, 'email': email})
+    elapsed_ms = round((time.monotonic() - started) * 1000)
+
+    if response.status_code != 200:
+        raise ghl_error('GHL lookup', response)
+
+    result = response.json()
+    logger.debug('[%s] Lookup response body: %s', event_id, Lazy(safe_json, result))
+    contact = result.get('contact')
+
+    if not contact:
+        log_stage(logging.WARNING, 'resolve', event_id, email=email, source='lookup', contact_id=None,
+                  ms=elapsed_ms, hint='make sure the contact exists in GHL with this exact email')
+        contact_cache.set(key, NO_CONTACT, ttl=CONTACT_CACHE_NEGATIVE_TTL)
+        return None
+
+    contact_id = contact.get('id')
+    log_stage(logging.INFO, 'resolve', event_id, email=email, source='lookup', contact_id=contact_id,
+              ms=elapsed_ms)
+    if contact_id:
+        contact_cache.set(key, contact_id)
+    return contact_id
+
+
+def process_queued_events(rows):
+    """Decode a group of queued events for one payment or contact and sync them as a single update.
+
+    Tracks idempotency per event ID, and per payment (``payment:<intent id>``) so that
+    events arriving after their payment has already been synced are skipped.
+    """
+    event_ids = [r['event_id'] for r in rows]
+    synced_payments = {
+        key for key in {r['correlation_key'] for r in rows if r['correlation_key']}
+        if get_event_state(f'payment:{key}') == EVENT_PROCESSED
+    }
+    for key in synced_payments:
+        skipped = [r['event_id'] for r in rows if r['correlation_key'] == key]
+        logger.info(f'[Queue] Payment {key} already synced - skipping {skipped}')
+        for event_id in skipped:
+            set_event_state(event_id, EVENT_PROCESSED)
+
+    pending = [r for r in rows if r['correlation_key'] not in synced_payments
+               and get_event_state(r['event_id']) != EVENT_PROCESSED]
+    if not pending:
+        logger.info(f'[Queue] Events {event_ids} already processed - skipping')
+        return
+
+    events = [json.loads(r['payload']) for r in pending]
+    log_stage(logging.INFO, 'dequeue', pending[0]['event_id'], events=[r['event_id'] for r in pending],
+              attempt=pending[0]['attempts'] + 1,
+              queued_ms=round((time.time() - pending[0]['received_at']) * 1000))
+    for r in pending:
+        set_event_state(r['event_id'], EVENT_IN_FLIGHT)
+    try:
+        payments = handle_payment_events(events)
+    except Exception:
+        for r in pending:
+            set_event_state(r['event_id'], EVENT_FAILED)
+        raise
+    for r in pending:
+        set_event_state(r['event_id'], EVENT_PROCESSED)
+    if payments:
+        for key in {r['correlation_key'] for r in pending if r['correlation_key']}:
+            set_event_state(f'payment:{key}', EVENT_PROCESSED)
+
+
+def handle_sync_failure(rows, worker_id, error):
+    """Schedule a retry for events that failed to sync, or dead-letter them."""
+    event_ids = [r['event_id'] for r in rows]
+    attempts = max(r['attempts'] for r in rows) + 1
+    retryable = is_retryable(error)
+
+    try:
+        if isinstance(error, CircuitOpenError):
+            # GHL is known to be down - park the events until the breaker probes again
+            delay = error.retry_after + random.uniform(0, GHL_BREAKER_COOLDOWN)
+            logger.info(f'[Queue] {error} - deferring {event_ids} for {delay:.0f}s')
+            retry_events(rows, worker_id, delay, count_attempt=False)
+        elif retryable and attempts < QUEUE_MAX_ATTEMPTS:
+            delay = retry_delay(attempts)
+            logger.warning(f'[Queue] Sync of {event_ids} failed (attempt {attempts}): {error} - '
+                           f'retrying in {delay:.1f}s')
+            retry_events(rows, worker_id, delay)
         else:
-            logger.info(f'[GHL] Using contact_id from metadata: {contact_id}')
-
-        # Prepare custom fields update payload (v2 format)
-        update_payload = {
-            'customFields': [
-                {'key': 'card_name', 'field_value': data['name']},
-                {'key': 'card_address_line_1', 'field_value': data['address_line_1']},
-                {'key': 'card_address_line_2', 'field_value': data['address_line_2']},
-                {'key': 'card_address_city', 'field_value': data['city']},
-                {'key': 'card_address_state', 'field_value': data['state']},
-                {'key': 'card_address_country', 'field_value': data['country']},
-                {'key': 'total_spend', 'field_value': data['amount']}
-            ]
-        }
+            reason = 'retries exhausted' if retryable else 'permanent error'
+            logger.error(f'[Queue] Sync of {event_ids} failed ({reason}, attempt {attempts}): {error}')
+            if not isinstance(error, SyncError):
+                import traceback
+                logger.error(f'Traceback:\n{traceback.format_exc()}')
+            dead_letter_events(rows, worker_id, error)
+    except sqlite3.Error as e:
+        # The lease will expire and the events will be picked up again
+        logger.error(f'[Queue] Could not reschedule events {event_ids}: {e}')
+
+
+def queue_worker(worker_id):
+    """Drain the event queue forever. A lease that is never acked is picked up again once it expires."""
+    while True:
+        try:
+            rows = lease_events(worker_id)
+        except sqlite3.Error as e:
+            logger.error(f'[Queue] Could not lease event: {e}')
+            time.sleep(QUEUE_POLL_INTERVAL)
+            continue
 
-        logger.info(f'[GHL] Update payload:\n{safe_json(update_payload)}')
+        if not rows:
+            _queue_wakeup.wait(QUEUE_POLL_INTERVAL)
+            _queue_wakeup.clear()
+            continue
 
-        # Update contact
-        update_url = f'{GHL_BASE_URL}/contacts/{contact_id}'
-        logger.info(f'[GHL] Updating contact: PUT {update_url}')
+        event_ids = [r['event_id'] for r in rows]
+        try:
+            process_queued_events(rows)
+        except Exception as e:
+            handle_sync_failure(rows, worker_id, e)
+            _queue_wakeup.set()
+            continue
 
-        update_response = requests.put(update_url, headers=headers, json=update_payload)
-        logger.info(f'[GHL] Update response status: {update_response.status_code}')
-        logger.info(f'[GHL] Update response body: {update_response.text[:1000]}')
+        try:
+            ack_events(rows, worker_id)
+        except sqlite3.Error as e:
+            logger.error(f'[Queue] Could not ack events {event_ids}: {e}')
+        # Events that arrived in this shard while we held it can be picked up now
+        _queue_wakeup.set()
 
-        if update_response.status_code == 200:
-            logger.info('=' * 40)
-            logger.info(f'SUCCESS: Updated GHL contact {contact_id}')
-            logger.info('=' * 40)
+
+_workers_started = False
+_workers_lock = threading.Lock()
+
+
+def start_queue_workers():
+    """Start the background sync workers for this process (once)."""
+    global _workers_started
+    with _workers_lock:
+        if _workers_started:
+            return
+        _workers_started = True
+
+    # Fail at boot, not on every event, if GHL is missing custom fields we write to.
+    # If GHL can't be reached the schema is loaded on the first write instead.
+    if GHL_API_KEY and GHL_LOCATION_ID:
+        try:
+            missing = custom_field_schema.load()
+        except (SyncError, requests.RequestException) as e:
+            logger.warning(f'[GHL] Could not load custom fields at startup: {e}')
         else:
-            logger.error('=' * 40)
-            logger.error(f'FAILED: GHL update returned {update_response.status_code}')
-            logger.error(f'Response: {update_response.text}')
-            logger.error('=' * 40)
+            if missing:
+                raise RuntimeError(f'GHL location {GHL_LOCATION_ID} has no custom fields with keys: '
+                                   f'{", ".join(missing)}')
 
-    except Exception as e:
-        logger.error(f'[GHL] Error syncing to GHL: {e}')
-        import traceback
-        logger.error(f'Traceback:\n{traceback.format_exc()}')
+    pending = retry_timer.load_pending()
+    threading.Thread(target=retry_timer.run, name='retry-timer', daemon=True).start()
+    if pending:
+        logger.info(f'[Queue] Loaded {pending} pending retry/coalescing deadlines')
+
+    process_tag = f'{os.getpid()}-{uuid.uuid4().hex[:6]}'
+    for i in range(QUEUE_WORKERS):
+        worker_id = f'{process_tag}-{i}'
+        thread = threading.Thread(target=queue_worker, args=(worker_id,), name=f'sync-worker-{i}', daemon=True)
+        thread.start()
+    logger.info(f'Started {QUEUE_WORKERS} queue workers (db: {SYNC_DB_PATH})')
+    if os.getenv('RAILWAY_PROJECT_ID') and not os.getenv('RAILWAY_VOLUME_MOUNT_PATH'):
+        logger.error('No Railway volume attached - queued events and the spend ledger in '
+                     f'{SYNC_DB_PATH} will be lost on the next deploy')
+
+    if GHL_API_KEY:
+        threading.Thread(target=ghl.warm, name='ghl-warmup', daemon=True).start()
+    if GHL_API_KEY and GHL_LOCATION_ID and CONTACT_INDEX_REFRESH > 0:
+        threading.Thread(target=contact_index.run, args=(CONTACT_INDEX_REFRESH,),
+                         name='contact-indexer', daemon=True).start()
+
+
+@app.cli.command('redrive')
+@click.option('--limit', type=int, default=None, help='Maximum number of events to re-queue.')
+@click.option('--rate', type=float, default=2.0, help='Events re-queued per second.')
+@click.option('--event-id', 'event_ids', multiple=True, help='Only re-queue these event IDs.')
+def redrive_command(limit, rate, event_ids):
+    """Re-queue dead-lettered events for another sync attempt."""
+    count = redrive_dead_letters(limit=limit, rate=rate, event_ids=event_ids)
+    click.echo(f'Re-queued {count} dead-lettered events')
+
+
+@app.cli.command('index-contacts')
+@click.option('--full', is_flag=True, help='Re-index every contact instead of only recently updated ones.')
+def index_contacts_command(full):
+    """Load the location's contacts into the local email -> contact ID index."""
+    count = contact_index.refresh(full=full)
+    click.echo(f'Indexed {count} contacts')
 
 
 if __name__ == '__main__':
@@ -351,4 +2338,5 @@ if __name__ == '__main__':
     logger.info(f'GHL Location ID configured: {bool(GHL_LOCATION_ID)}')
     logger.info(f'GHL API Key configured: {bool(GHL_API_KEY)}')
     logger.info(f'Stripe Webhook Secret configured: {bool(STRIPE_WEBHOOK_SECRET)}')
+    start_queue_workers()
     app.run(host='0.0.0.0', port=port)
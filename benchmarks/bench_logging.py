@@ -0,0 +1,306 @@
+"""Benchmark the logging cost of extracting one payment event at different log settings.
+
+Usage: python benchmarks/bench_logging.py [iterations]
+
+Reports CPU time and bytes of log output per event for LOG_LEVEL=DEBUG (full
+event dumps and per-field detail), INFO text, INFO json and WARNING, with the
+baseline's eager extraction logging as a reference row.
+"""
+import io
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app  # noqa: E402
+
+SAMPLE_EVENT = {
+    'id': 'evt_3Nbench',
+    'object': 'event',
+    'api_version': '2023-10-16',
+    'created': 1700000000,
+    'type': 'payment_intent.succeeded',
+    'data': {
+        'object': {
+            'id': 'pi_3Nbench',
+            'object': 'payment_intent',
+            'amount': 4900,
+            'amount_received': 4900,
+            'currency': 'usd',
+            'customer': 'cus_Obench',
+            'description': 'Order #1234',
+            'latest_charge': 'ch_3Nbench',
+            'metadata': {'order_id': '1234', 'source': 'funnel'},
+            'payment_method': 'pm_1Nbench',
+            'payment_method_types': ['card'],
+            'receipt_email': 'customer@example.com',
+            'status': 'succeeded',
+            'charges': {
+                'object': 'list',
+                'data': [{
+                    'id': 'ch_3Nbench',
+                    'object': 'charge',
+                    'amount': 4900,
+                    'billing_details': {
+                        'name': 'Jane Customer',
+                        'email': 'customer@example.com',
+                        'phone': None,
+                        'address': {
+                            'line1': '123 Main St',
+                            'line2': 'Apt 4',
+                            'city': 'Springfield',
+                            'state': 'IL',
+                            'postal_code': '62701',
+                            'country': 'US',
+                        },
+                    },
+                    'payment_method_details': {
+                        'type': 'card',
+                        'card': {'brand': 'visa', 'last4': '4242', 'exp_month': 12, 'exp_year': 2030},
+                    },
+                }],
+            },
+        },
+    },
+}
+
+
+# Copy of the baseline (pre-structured-logging) extraction path, minus the GHL call,
+# so the report has a reference row for the old eager logging
+baseline_logger = logging.getLogger('baseline')
+
+
+def safe_json(obj, max_length=2000):
+    """Safely convert object to JSON string for logging, truncating if needed."""
+    try:
+        result = json.dumps(obj, default=str, indent=2)
+        if len(result) > max_length:
+            return result[:max_length] + '... [truncated]'
+        return result
+    except Exception as e:
+        return f'[Could not serialize: {e}]'
+
+
+def baseline_handle_payment_event(event):
+    """The original handle_payment_event up to the GHL call, with its eager logging."""
+    try:
+        event_type = event['type']
+        data = event['data']['object']
+
+        baseline_logger.info('=' * 60)
+        baseline_logger.info('WEBHOOK RECEIVED')
+        baseline_logger.info('=' * 60)
+        baseline_logger.info(f'Event ID: {event.get("id", "unknown")}')
+        baseline_logger.info(f'Event Type: {event_type}')
+
+        baseline_logger.info('-' * 40)
+        baseline_logger.info('PROCESSING PAYMENT EVENT')
+        baseline_logger.info('-' * 40)
+
+        # Log all available top-level keys in the data object
+        baseline_logger.info(f'Available data keys: {list(data.keys())}')
+
+        # Log metadata - this often contains contactId from GHL
+        metadata = data.get('metadata', {})
+        baseline_logger.info(f'[Metadata] {safe_json(metadata)}')
+
+        # Check for GHL contactId in metadata FIRST (most reliable method)
+        contact_id = metadata.get('contactId')
+        if contact_id:
+            baseline_logger.info(f'[Contact] Found contactId in metadata: {contact_id}')
+        else:
+            baseline_logger.info('[Contact] No contactId in metadata')
+
+        # Log key fields for debugging
+        baseline_logger.debug(f'Full event data:\n{safe_json(data)}')
+
+        # Extract customer email from various possible locations (as fallback)
+        email = None
+        email_source = None
+
+        # 1. checkout.session.completed: customer_details.email
+        if 'customer_details' in data and data['customer_details']:
+            cd_email = data['customer_details'].get('email')
+            baseline_logger.info(f'[Email Check 1] customer_details.email: {cd_email}')
+            if cd_email and not email:
+                email = cd_email
+                email_source = 'customer_details.email'
+
+        # 2. payment_intent: receipt_email
+        receipt_email = data.get('receipt_email')
+        baseline_logger.info(f'[Email Check 2] receipt_email: {receipt_email}')
+        if receipt_email and not email:
+            email = receipt_email
+            email_source = 'receipt_email'
+
+        # 3. payment_intent: billing_details.email (direct)
+        if 'billing_details' in data and data['billing_details']:
+            bd_email = data['billing_details'].get('email')
+            baseline_logger.info(f'[Email Check 3] billing_details.email: {bd_email}')
+            if bd_email and not email:
+                email = bd_email
+                email_source = 'billing_details.email'
+
+        # 4. payment_intent: charges.data[0].billing_details.email
+        if 'charges' in data and data['charges'].get('data'):
+            charges = data['charges']['data']
+            if charges and charges[0].get('billing_details'):
+                charge_email = charges[0]['billing_details'].get('email')
+                baseline_logger.info(f'[Email Check 4] charges[0].billing_details.email: {charge_email}')
+                if charge_email and not email:
+                    email = charge_email
+                    email_source = 'charges[0].billing_details.email'
+        else:
+            baseline_logger.info('[Email Check 4] charges.data: not present')
+
+        # 5. payment_intent: latest_charge.billing_details.email (if expanded)
+        if 'latest_charge' in data:
+            if isinstance(data['latest_charge'], dict):
+                lc = data['latest_charge']
+                if lc.get('billing_details'):
+                    lc_email = lc['billing_details'].get('email')
+                    baseline_logger.info(f'[Email Check 5] latest_charge.billing_details.email: {lc_email}')
+                    if lc_email and not email:
+                        email = lc_email
+                        email_source = 'latest_charge.billing_details.email'
+            else:
+                baseline_logger.info(f'[Email Check 5] latest_charge is string ID: {data["latest_charge"]}')
+        else:
+            baseline_logger.info('[Email Check 5] latest_charge: not present')
+
+        # 6. Check for customer object or customer email
+        if 'customer_email' in data:
+            cust_email = data.get('customer_email')
+            baseline_logger.info(f'[Email Check 6] customer_email: {cust_email}')
+            if cust_email and not email:
+                email = cust_email
+                email_source = 'customer_email'
+
+        baseline_logger.info('=' * 40)
+        if contact_id:
+            baseline_logger.info(f'USING CONTACT ID FROM METADATA: {contact_id}')
+        elif email:
+            baseline_logger.info(f'EMAIL FOUND: {email}')
+            baseline_logger.info(f'Source: {email_source}')
+        else:
+            baseline_logger.error('NO CONTACT ID OR EMAIL FOUND')
+            baseline_logger.error('Cannot process payment - need either contactId in metadata or email')
+            return
+        baseline_logger.info('=' * 40)
+
+        # Extract billing details from various sources
+        billing_details = {}
+        address = {}
+        billing_source = 'none'
+
+        # Try billing_details first
+        if data.get('billing_details'):
+            billing_details = data['billing_details']
+            address = billing_details.get('address', {}) or {}
+            billing_source = 'billing_details'
+            baseline_logger.info(f'[Billing] Found in billing_details: {safe_json(billing_details)}')
+
+        # Try charges array for payment_intent
+        if not billing_details.get('name') and 'charges' in data and data['charges'].get('data'):
+            charges = data['charges']['data']
+            if charges and charges[0].get('billing_details'):
+                billing_details = charges[0]['billing_details']
+                address = billing_details.get('address', {}) or {}
+                billing_source = 'charges[0].billing_details'
+                baseline_logger.info(f'[Billing] Found in charges[0]: {safe_json(billing_details)}')
+
+        # Try customer_details for checkout.session
+        if not billing_details.get('name') and 'customer_details' in data:
+            customer_details = data.get('customer_details', {}) or {}
+            billing_details['name'] = customer_details.get('name')
+            if not address:
+                address = customer_details.get('address', {}) or {}
+            billing_source = 'customer_details'
+            baseline_logger.info(f'[Billing] Found in customer_details: {safe_json(customer_details)}')
+
+        baseline_logger.info(f'[Billing] Final source: {billing_source}')
+        baseline_logger.info(f'[Billing] Name: {billing_details.get("name", "NOT FOUND")}')
+        baseline_logger.info(f'[Billing] Address: {safe_json(address)}')
+
+        # Extract amount and convert from cents to dollars
+        amount_cents = data.get('amount_total') or data.get('amount') or 0
+        amount_dollars = f"{amount_cents / 100:.2f}"
+        baseline_logger.info(f'[Amount] Cents: {amount_cents} -> Dollars: ${amount_dollars}')
+
+        # Prepare data for GHL
+        ghl_data = {
+            'name': billing_details.get('name', ''),
+            'address_line_1': address.get('line1', ''),
+            'address_line_2': address.get('line2', ''),
+            'city': address.get('city', ''),
+            'state': address.get('state', ''),
+            'country': address.get('country', ''),
+            'amount': amount_dollars
+        }
+
+        baseline_logger.info('-' * 40)
+        baseline_logger.info('DATA TO SEND TO GHL:')
+        baseline_logger.info(f'Contact ID: {contact_id}')
+        baseline_logger.info(f'Email (fallback): {email}')
+        baseline_logger.info(f'GHL Data: {safe_json(ghl_data)}')
+        baseline_logger.info('-' * 40)
+
+        return ghl_data
+
+    except Exception as e:
+        baseline_logger.error(f'Error processing payment event: {e}')
+        import traceback
+        baseline_logger.error(f'Traceback:\n{traceback.format_exc()}')
+
+
+class CountingStream(io.TextIOBase):
+    """Discards output, counting the bytes written."""
+
+    def __init__(self):
+        self.bytes = 0
+
+    def write(self, text):
+        self.bytes += len(text.encode('utf-8'))
+        return len(text)
+
+
+def run(level, fmt, iterations, baseline=False):
+    stream = CountingStream()
+    handler = logging.StreamHandler(stream)
+    if fmt == 'json':
+        handler.setFormatter(app.StructuredFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    # Write synchronously so the formatting and I/O cost is counted here
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level)
+
+    started = time.process_time()
+    for _ in range(iterations):
+        if baseline:
+            baseline_handle_payment_event(SAMPLE_EVENT)
+            continue
+        app.log_stage(logging.INFO, 'received', SAMPLE_EVENT['id'], type=SAMPLE_EVENT['type'],
+                      payment='pi_3Nbench', action='queued', bytes=2048)
+        app.extract_payment_data(SAMPLE_EVENT)
+    cpu = time.process_time() - started
+    return cpu / iterations * 1e6, stream.bytes / iterations
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    print(f'{"mode":<18}{"cpu us/event":>14}{"bytes/event":>14}')
+    # The baseline always logged at DEBUG
+    cpu_us, size = run('DEBUG', 'text', iterations, baseline=True)
+    print(f'{"baseline DEBUG":<18}{cpu_us:>14.1f}{size:>14.0f}')
+    for level, fmt in (('DEBUG', 'text'), ('INFO', 'text'), ('INFO', 'json'), ('WARNING', 'text')):
+        cpu_us, size = run(level, fmt, iterations)
+        print(f'{level + " " + fmt:<18}{cpu_us:>14.1f}{size:>14.0f}')
+
+
+if __name__ == '__main__':
+    main()
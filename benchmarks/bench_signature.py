@@ -0,0 +1,66 @@
+"""Benchmark webhook verification + decoding: app.verify_stripe_signature vs the stripe library.
+
+Usage: python benchmarks/bench_signature.py [iterations]
+
+Needs the stripe package for the comparison (pip install stripe); it is not a
+runtime dependency of the app.
+"""
+import hashlib
+import hmac
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app  # noqa: E402
+from bench_logging import SAMPLE_EVENT  # noqa: E402
+
+SECRET = 'whsec_benchmark_current'
+OLD_SECRET = 'whsec_benchmark_previous'
+
+
+def sign(payload, secret):
+    timestamp = str(int(time.time()))
+    signature = hmac.new(secret.encode(), timestamp.encode() + b'.' + payload, hashlib.sha256).hexdigest()
+    return f't={timestamp},v1={signature}'
+
+
+def own_path(payload, header, secrets):
+    app.verify_stripe_signature(payload, header, secrets)
+    return json.loads(payload)
+
+
+def bench(label, func, iterations):
+    func()
+    started = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    per_call = (time.perf_counter() - started) / iterations * 1e6
+    print(f'{label:<44}{per_call:>10.1f} us')
+    return per_call
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    payload = json.dumps(SAMPLE_EVENT).encode()
+    header = sign(payload, SECRET)
+    print(f'payload: {len(payload)} bytes, {iterations} iterations')
+
+    own = bench('verify_stripe_signature + json.loads', lambda: own_path(payload, header, [SECRET]), iterations)
+    bench('  ... matching the 2nd of 2 rotated secrets',
+          lambda: own_path(payload, header, [OLD_SECRET, SECRET]), iterations)
+
+    try:
+        import stripe
+    except ImportError:
+        print('stripe is not installed - skipping stripe.Webhook.construct_event')
+        return
+    lib = bench('stripe.Webhook.construct_event',
+                lambda: stripe.Webhook.construct_event(payload, header, SECRET), iterations)
+    print(f'speedup: {lib / own:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
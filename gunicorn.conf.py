@@ -0,0 +1,7 @@
+"""Gunicorn configuration - loaded automatically by `gunicorn app:app`."""
+
+
+def post_worker_init(worker):
+    """Start the background sync workers inside each web worker process."""
+    from app import start_queue_workers
+    start_queue_workers()
@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Keep the tests' queue and ledger out of the working directory
+os.environ.setdefault('SYNC_DB_PATH', os.path.join(tempfile.mkdtemp(), 'sync.db'))
@@ -0,0 +1,64 @@
+import pytest
+
+import app
+
+CONTACT_ID = 'contact_ledger'
+
+
+class FakeResponse:
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self.body = body or {}
+        self.headers = {}
+        self.text = str(self.body)
+
+    def json(self):
+        return self.body
+
+
+@pytest.fixture
+def ghl(monkeypatch):
+    """Fake the GHL API and return the custom fields of each contact update."""
+    monkeypatch.setattr(app, 'GHL_API_KEY', 'test-key')
+    monkeypatch.setattr(app, 'GHL_LOCATION_ID', 'loc_test')
+    updates = []
+
+    def request(method, url, **kwargs):
+        if '/customFields' in url:
+            return FakeResponse(200, {'customFields': [
+                {'id': f'id_{key}', 'fieldKey': f'contact.{key}'} for key in app.CUSTOM_FIELD_KEYS.values()
+            ]})
+        if method == 'PUT':
+            updates.append({f['id'][len('id_'):]: f['field_value'] for f in kwargs['json']['customFields']})
+        return FakeResponse(200, {'contact': {'id': CONTACT_ID}})
+
+    monkeypatch.setattr(app.ghl.session, 'request', request)
+    return updates
+
+
+def event(event_id, event_type, obj, created):
+    obj = {'metadata': {'contactId': CONTACT_ID}, **obj}
+    return {'id': event_id, 'type': event_type, 'created': created, 'data': {'object': obj}}
+
+
+def test_subscription_checkout_counted_once(ghl):
+    checkout = event('evt_cs', 'checkout.session.completed', {
+        'object': 'checkout.session', 'mode': 'subscription', 'payment_intent': None,
+        'invoice': 'in_1', 'amount_total': 2000,
+        'customer_details': {'email': 'sub@example.com', 'name': 'Sub Scriber'},
+    }, created=100)
+    charge = event('evt_ch', 'charge.succeeded', {
+        'object': 'charge', 'id': 'ch_1', 'payment_intent': 'pi_sub', 'invoice': 'in_1', 'amount': 2000,
+        'billing_details': {'email': 'sub@example.com', 'name': 'Sub Scriber'},
+    }, created=101)
+
+    app.handle_payment_events([checkout])
+    app.handle_payment_events([charge])
+
+    rows = app.get_db().execute(
+        'SELECT payment_id, amount_cents FROM payments WHERE contact_id = ?', (CONTACT_ID,)
+    ).fetchall()
+    assert [tuple(r) for r in rows] == [('pi_sub', 2000)]
+    assert app.spend_ledger.total(CONTACT_ID) == 2000
+    total_key = app.CUSTOM_FIELD_KEYS['amount']
+    assert [u[total_key] for u in ghl if total_key in u][-1] == '20.00'
@@ -0,0 +1,63 @@
+import hashlib
+import hmac
+import time
+
+import pytest
+
+import app
+from app import SignatureError, verify_stripe_signature
+
+PAYLOAD = b'{"id": "evt_1", "type": "payment_intent.succeeded"}'
+SECRET = 'whsec_current'
+
+
+def sign(payload, secret, timestamp=None):
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    signature = hmac.new(secret.encode(), f'{timestamp}.'.encode() + payload, hashlib.sha256).hexdigest()
+    return f't={timestamp},v1={signature}'
+
+
+def test_valid_signature():
+    verify_stripe_signature(PAYLOAD, sign(PAYLOAD, SECRET), [SECRET])
+
+
+def test_wrong_secret():
+    with pytest.raises(SignatureError):
+        verify_stripe_signature(PAYLOAD, sign(PAYLOAD, 'whsec_other'), [SECRET])
+
+
+def test_tampered_payload():
+    with pytest.raises(SignatureError):
+        verify_stripe_signature(PAYLOAD + b' ', sign(PAYLOAD, SECRET), [SECRET])
+
+
+def test_expired_timestamp():
+    header = sign(PAYLOAD, SECRET, timestamp=int(time.time()) - 600)
+    with pytest.raises(SignatureError, match='tolerance'):
+        verify_stripe_signature(PAYLOAD, header, [SECRET], tolerance=300)
+
+
+def test_rotated_second_secret():
+    verify_stripe_signature(PAYLOAD, sign(PAYLOAD, 'whsec_next'), [SECRET, 'whsec_next'])
+
+
+@pytest.mark.parametrize('header', [
+    '',
+    'garbage',
+    't=123',
+    'v1=abc',
+    't=abc,v1=abc',
+    't=١٢٣,v1=abc',
+    f't={int(time.time())},v1=éabc',
+])
+def test_malformed_header(header):
+    with pytest.raises(SignatureError):
+        verify_stripe_signature(PAYLOAD, header, [SECRET])
+
+
+def test_webhook_rejects_non_ascii_signature(monkeypatch):
+    monkeypatch.setattr(app, 'STRIPE_WEBHOOK_SECRETS', [SECRET])
+    response = app.app.test_client().post(
+        '/webhook', data=PAYLOAD, headers={'Stripe-Signature': f't={int(time.time())},v1=éabc'}
+    )
+    assert response.status_code == 400